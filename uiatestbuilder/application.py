@@ -1,27 +1,48 @@
+import os
+import json
 import queue
+import threading
 
 import tkinter
 from tkinter import messagebox
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 
+import inputlog
+import instrument
+import journal
+import locators
 import scenario
+import statuslog
+import scenarioview
 import recorder
 import scenariotools
+import treesnapshot
+import uiaruntime
 import uiatools
 
 
 class Application:
+    # recorder threads only set flags, the Tk thread picks them up this often
+    RECORDER_POLL_MS = 50
+
     def __init__(self):
         self.sc = scenario.Scenario()
-        self.rec = recorder. Recorder()
+        self.view = scenarioview.ScenarioView(self.sc)
         self.is_recording = False
         self.current_step = None
         self.step_counter = 1
-        self.action_list_current_insert_index = None
         self.active_on_stop_group = []
+        self.input_log = None
+        # UIATESTBUILDER_TRACE=<path> profiles the session into chrome trace json
+        self.trace_path = os.environ.get('UIATESTBUILDER_TRACE')
+        if self.trace_path:
+            instrument.enable()
 
         self.main_wnd = tkinter.Tk()
         self.main_wnd.title('Pywinauto test generator')
+        self.actions_notified = threading.Event()
+        self.item_path_notified = threading.Event()
+        self.rec = recorder.Recorder(self.notify_actions_recorded, self.notify_item_path_changed)
 
         box = tkinter.Frame(self.main_wnd)
         box.pack(fill=tkinter.BOTH, expand=1)
@@ -57,42 +78,63 @@ class Application:
         btn = tkinter.Button(box, text='Tune...', command=self.on_tune_item_path)
         btn.pack()
         self.active_on_stop_group.append(btn)
+        btn = tkinter.Button(box, text='Optimize', command=self.on_optimize_locators)
+        btn.pack()
+        self.active_on_stop_group.append(btn)
+        btn = tkinter.Button(box, text='Validate', command=self.on_validate_locators)
+        btn.pack()
+        self.active_on_stop_group.append(btn)
 
-        frame = tkinter.Frame(box)
-        frame.pack(fill=tkinter.X, expand=1)
-        scrollbar = tkinter.Scrollbar(frame)
-        scrollbar.pack(side=tkinter.RIGHT, fill=tkinter.Y)
-        self.status_area = tkinter.Text(frame, wrap=tkinter.WORD, yscrollcommand=scrollbar.set)
-        self.status_area.pack(fill=tkinter.X, expand=1)
-        scrollbar.config(command=self.status_area.yview)
+        data_dir = os.path.join(os.path.expanduser('~'), '.uiatestbuilder')
+        # raw input of the last record session for offline replay, see inputlog.py
+        self.input_log_path = os.path.join(data_dir, 'last_record.uiain')
+        # timings of actions of the last run, see uiaruntime.TimingReport
+        self.timing_report_path = os.path.join(data_dir, 'last_run_timing.json')
+        # windows captured by the last optimization, see treesnapshot.py
+        self.snapshot_path = os.path.join(data_dir, 'last_snapshot.uiats')
+        self.status = statuslog.StatusLog(file_path=os.path.join(data_dir, 'status.log'))
+        self.status_area = StatusArea(box, self.status)
+
+        self.journal = journal.Journal(data_dir)
+        recovered = self.journal.recover()
+        if recovered:
+            self.set_scenario(recovered)
+            self.add_status('Recovered unsaved scenario of the previous session')
 
-    def add_status(self, text):
-        self.status_area.insert(tkinter.END, text + '\n')
-        self.status_area.see(tkinter.END)
+        self.journal.start(self.sc)
+        self.main_wnd.after(self.RECORDER_POLL_MS, self.poll_recorder)
+
+    def add_status(self, text, level=statuslog.INFO):
+        self.status.add(text, level)
 
     def new_scenario_set(self):
         self.action_list.delete(0, tkinter.END)
-        self.status_area.delete(1.0, tkinter.END)
+        self.status.clear()
         self.step_counter = 1
 
-    def on_new_scenario(self):
-        self.sc = scenario.Scenario()
+    def set_scenario(self, sc):
+        self.sc = sc
+        self.view = scenarioview.ScenarioView(sc)
+        # records of the previous scenario are not reused by new recordings
+        self.rec.reset_paths()
         self.new_scenario_set()
+        self.step_counter += len(sc.steps)
+        # one insert call for all rows
+        rows = [step.name if not action else self.action_to_row(action) for step, action in self.view.rows()]
+        if rows:
+            self.action_list.insert(tkinter.END, *rows)
+
+    def on_new_scenario(self):
+        self.set_scenario(scenario.Scenario())
+        self.journal.start(self.sc)
 
     def on_load_scenario(self):
         path = askopenfilename(filetypes=(("Scenario files", "*.uiasc"),))
         if not path:
             return
 
-        self.sc = scenariotools.load(path)
-        self.new_scenario_set()
-
-        for step in self.sc.steps:
-            self.action_list_add_step(step)
-            self.step_counter += 1
-            for action in step.actions:
-                self.action_list_add_action(tkinter.END, action)
-
+        self.set_scenario(scenariotools.load(path))
+        self.journal.start(self.sc)
         self.add_status('Loaded: ' + path)
 
     def on_save_scenario(self):
@@ -105,7 +147,9 @@ class Application:
         index, step, action = self.get_selected_step_action()
         if step and not action:
             self.add_status('Run step: ' + step.name)
-            exception_type, exception_data = scenariotools.run_steps((step,))
+            report = uiaruntime.TimingReport()
+            exception_type, exception_data = scenariotools.run_steps(self.sc, (step,), report)
+            self.add_timing_status(report)
             if exception_type == 'ElementAmbiguousError' or exception_type == 'ElementNotFoundError':
                 step, action, record = exception_data
                 if exception_type == 'ElementNotFoundError':
@@ -119,16 +163,44 @@ class Application:
                                      'or other property to distinguish right item.'
 
                 self.add_status(f'Item "{record.friendly_name()}" {problem} '
-                                f'(item_id "{record.id}", step {self.sc.steps.index(step) + 1} "{step.name}", '
-                                f'action {step.actions.index(action) + 1} "{self.action_to_str(action)}"). '
-                                f'{recommendation}')
+                                f'(item_id "{record.id}", step {self.view.step_index(step) + 1} "{step.name}", '
+                                f'action {self.view.action_index(action) + 1} "{self.action_to_str(action)}"). '
+                                f'{recommendation}', statuslog.ERROR)
 
             elif exception_type == 'OtherError':
-                self.add_status(exception_data)
+                self.add_status(exception_data, statuslog.ERROR)
             else:
                 self.add_status('Success')
         else:
-            self.add_status('No step selected')
+            self.add_status('No step selected', statuslog.WARNING)
+
+    def add_timing_status(self, report):
+        full_report = 'full report: ' + self.timing_report_path
+        try:
+            with open(self.timing_report_path, 'w', encoding='utf-8') as file:
+                json.dump(report.as_dict(), file, indent=1)
+        except OSError as exc:
+            full_report = 'full report not saved'
+            self.add_status(f'Timing report is not saved to {self.timing_report_path}: {exc}', statuslog.WARNING)
+
+        rows = report.slowest_records(10, cached=False)
+        if not rows:
+            return
+
+        lines = [f'Slowest locators ({full_report}):']
+        for action_id, record_id, seconds, cached, retries in rows:
+            step, action = self.sc.registry.find_action(action_id)
+            record = self.sc.registry.find_record(record_id)
+            if not step or not record:
+                continue
+
+            action_report = report.actions.get(action_id, [0.0, 0.0, 0])
+            lines.append(f'{seconds * 1e3:.1f} ms "{record.friendly_name()}" (item_id "{record.id}", '
+                         f'step "{step.name}", action {self.view.action_index(action) + 1} '
+                         f'"{self.action_to_str(action)}", '
+                         f'action time {action_report[1] * 1e3:.1f} ms, retries {retries})')
+
+        self.add_status('\n'.join(lines))
 
     def set_current_step(self):
         self.current_step = None
@@ -138,61 +210,130 @@ class Application:
         elif len(self.sc.steps):
             self.current_step = self.sc.steps[-1]
 
-        if not self.current_step:
-            return False
-
-        index = 0
-        for step in self.sc.steps:
-            index += len(step.actions) + 1
-            if step == self.current_step:
-                self.action_list_current_insert_index = index
-                break
-
-        return True
+        return self.current_step is not None
 
     def on_start_record(self):
         if self.is_recording:
-            self.is_recording = False
             self.rec.stop()
+            self.input_log.close()
+            self.on_actions_recorded()
+            self.is_recording = False
+            stats = self.rec.input.stats
+            self.add_status('Stop record, input: ' + str(stats), statuslog.WARNING if stats.dropped else statuslog.INFO)
             self.record_btn['text'] = 'Start'
             for one in self.active_on_stop_group:
                 one['state'] = tkinter.NORMAL
         else:
             if self.set_current_step():
                 self.is_recording = True
-                self.rec.start()
-                self.get_action_loop()
+                self.input_log = open(self.input_log_path, 'wb')
+                self.rec.start(inputlog.InputLogWriter(self.input_log))
                 self.record_btn['text'] = 'Stop'
                 for one in self.active_on_stop_group:
                     one['state'] = tkinter.DISABLED
 
                 self.add_status('Start record step: ' + self.current_step.name)
             else:
-                self.add_status('No step selected')
+                self.add_status('No step selected', statuslog.WARNING)
 
     def on_add_step(self):
         dlg = StepNameDlg(self.step_counter)
         if dlg.show() == 'OK':
             step = scenario.Step(dlg.step_name)
-            self.sc.steps.append(step)
-            self.action_list_add_step(step)
+            self.view.add_step(step)
+            self.journal.add_step(step)
+            self.action_list.insert(tkinter.END, step.name)
+            self.action_list.see(tkinter.END)
             self.step_counter += 1
 
     def on_tune_item_path(self):
         index, step, action = self.get_selected_step_action()
         if action and  isinstance(action, scenario.ItemAction):
-            TuneItemPathDlg(action.item_path).show()
+            versions = [record.version for record in action.item_path.path]
+            if TuneItemPathDlg(action.item_path).show() == 'OK':
+                for record, version in zip(action.item_path.path, versions):
+                    if record.version != version:
+                        self.journal.tune(record)
         else:
-            self.add_status('No action on item selected')
+            self.add_status('No action on item selected', statuslog.WARNING)
+
+    def capture_snapshot(self):
+        """ Returns (snapshot, description of where it is) or (None, None) if the tree is not captured, failures
+            go to the status log. Snapshot not saved to the file is still usable in memory """
+        # only windows the scenario works with are captured with their descendants
+        windows = [action.item_path.path[1].search_criteria() for step in self.sc.steps for action in step.actions
+                   if isinstance(action, scenario.ItemAction) and len(action.item_path.path) > 1]
+        try:
+            snapshot = treesnapshot.TreeSnapshot.capture(windows=windows)
+        except Exception as exc:
+            self.add_status(f'Items are not captured: {exc}', statuslog.ERROR)
+            return None, None
 
-    def action_list_add_step(self, step):
-        self.action_list.insert(tkinter.END, step.name)
-        self.action_list.see(tkinter.END)
+        try:
+            snapshot.save(self.snapshot_path)
+        except OSError as exc:
+            self.add_status(f'Captured items are not saved to {self.snapshot_path}: {exc}', statuslog.ERROR)
+            return snapshot, f'{len(snapshot)} items captured, not saved'
+
+        return snapshot, f'{len(snapshot)} items captured to {self.snapshot_path}'
+
+    def on_validate_locators(self):
+        snapshot, captured = self.capture_snapshot()
+        if snapshot is None:
+            return
 
-    def on_add_action(self, action):
-        self.current_step.actions.append(action)
-        self.action_list_add_action(self.action_list_current_insert_index, action)
-        self.action_list_current_insert_index += 1
+        report = locators.validate(self.sc, snapshot)
+        self.add_status(f'Validated locators ({captured}): {report}',
+                        statuslog.ERROR if report.problems else statuslog.INFO)
+        for problem in report.problems:
+            step, action = problem.actions[0]
+            self.add_status(f'{problem}, first in step {self.view.step_index(step) + 1} "{step.name}", '
+                            f'action {self.view.action_index(action) + 1} "{self.action_to_str(action)}". '
+                            f'Press "Optimize" or "Tune" the item', statuslog.ERROR)
+
+    def on_optimize_locators(self):
+        msg = 'Tune item paths of all actions against the application as it is on the screen now ?'
+        result = tkinter.messagebox.askquestion('', msg, icon='warning', default=tkinter.messagebox.NO)
+        if result != 'yes':
+            return
+
+        snapshot, captured = self.capture_snapshot()
+        if snapshot is None:
+            return
+
+        optimized = locators.LocatorOptimizer(snapshot).optimize(self.sc)
+        for record in optimized.tuned_records:
+            self.journal.tune(record)
+
+        for action in optimized.shortened_actions:
+            self.journal.set_path(action)
+            step = self.sc.registry.find_action(action.id)[0]
+            row = self.view.action_row(step, action)
+            self.action_list.delete(row)
+            self.action_list.insert(row, self.action_to_row(action))
+
+        self.add_status(f'Optimized locators ({captured}): {optimized}')
+        for step, action, exc in optimized.failed[:10]:
+            problem = str(exc)
+            if isinstance(exc, treesnapshot.LocatorError):
+                record = action.item_path.path[exc.record_index + 1]
+                problem = f'item "{record.friendly_name()}" (item_id "{record.id}") ' + \
+                          ('has duplicates' if isinstance(exc, treesnapshot.LocatorAmbiguous) else 'not found')
+
+            self.add_status(f'Not optimized: step "{step.name}", action {self.view.action_index(action) + 1} '
+                            f'"{self.action_to_str(action)}", {problem}', statuslog.WARNING)
+
+    def on_add_actions(self, actions):
+        index = None
+        for action in actions:
+            row = self.view.add_action(self.current_step, action)
+            index = row if index is None else index
+            self.journal.add_action(self.current_step, action)
+
+        if actions:
+            # new rows follow each other at the end of the current step
+            self.action_list.insert(index, *[self.action_to_row(one) for one in actions])
+            self.action_list.see(index + len(actions) - 1)
 
     @staticmethod
     def action_to_str(action):
@@ -206,29 +347,46 @@ class Application:
 
         return text
 
-    def action_list_add_action(self, index, action):
-        text = '    ' + self.action_to_str(action)
-        self.action_list.insert(index, text)
-        self.action_list.see(index)
+    def action_to_row(self, action):
+        return '    ' + self.action_to_str(action)
 
-    def get_action_loop(self):
-        if self.is_recording:
-            self.add_status(str(self.rec.get_current_item_path()))
+    def notify_actions_recorded(self):
+        # called by recorder threads, which must not wait for Tk: the Tk thread joins them on stop
+        self.actions_notified.set()
+
+    def notify_item_path_changed(self):
+        self.item_path_notified.set()
+
+    def poll_recorder(self):
+        if self.actions_notified.is_set():
+            self.on_actions_recorded()
+        if self.item_path_notified.is_set():
+            self.item_path_notified.clear()
+            self.on_item_path_changed()
+
+        self.main_wnd.after(self.RECORDER_POLL_MS, self.poll_recorder)
 
+    def on_actions_recorded(self):
+        self.actions_notified.clear()
+        actions = []
+        while True:
             try:
-                action = self.rec.action_queue.get_nowait()
+                actions.append(self.rec.action_queue.get_nowait())
             except queue.Empty:
-                action = None
+                break
 
-            if action:
-                self.on_add_action(action)
+        # actions classified after stop, like the click on the stop button, are dropped
+        if self.is_recording:
+            self.on_add_actions(actions)
 
-            self.main_wnd.after(1000, self.get_action_loop)
+    def on_item_path_changed(self):
+        if self.is_recording:
+            self.add_status(str(self.rec.get_current_item_path()))
 
     def on_del_action(self):
         index, step, action = self.get_selected_step_action()
         if index is None:
-            self.add_status('No step or action selected')
+            self.add_status('No step or action selected', statuslog.WARNING)
             return
 
         msg = 'Are sure you want to delete item ?'
@@ -238,10 +396,12 @@ class Application:
 
         if action:
             self.action_list.delete(index)
-            step.actions.remove(action)
+            self.view.remove_action(index)
+            self.journal.remove_action(action)
         else:
             self.action_list.delete(index, index + len(step.actions))
-            self.sc.steps.remove(step)
+            self.view.remove_step(index)
+            self.journal.remove_step(step)
 
         self.action_list.selection_clear(0, tkinter.END)
 
@@ -251,24 +411,75 @@ class Application:
             return None, None, None
 
         index = int(index[0])
-        count = 0
-        for step in self.sc.steps:
-            if index == count:
-                return index, step, None
-            else:
-                n = len(step.actions)
-                if index <= count + n:
-                    for action in step.actions:
-                        count += 1
-                        if index == count:
-                            return index, step, action
-                else:
-                    count += n + 1
-
-        assert False
+        step, action, action_index = self.view.locate(index)
+        return index, step, action
 
     def run(self):
         self.main_wnd.mainloop()
+        self.journal.close()
+        if self.trace_path:
+            instrument.enable(False)
+            instrument.export_chrome_trace(self.trace_path)
+            self.status.add('Trace: ' + self.trace_path + '\n' + instrument.summary())
+
+
+class StatusArea:
+    """ Text widget showing only the visible lines of the status log """
+
+    colours = {statuslog.WARNING: 'dark orange', statuslog.ERROR: 'red'}
+
+    def __init__(self, parent, log: statuslog.StatusLog, height=24):
+        self.log = log
+        self.height = height
+        self.first = 0
+        self.follow = True
+        self.refresh_pending = False
+
+        frame = tkinter.Frame(parent)
+        frame.pack(fill=tkinter.X, expand=1)
+        self.scrollbar = tkinter.Scrollbar(frame, command=self.on_scroll)
+        self.scrollbar.pack(side=tkinter.RIGHT, fill=tkinter.Y)
+        self.text = tkinter.Text(frame, height=height, wrap=tkinter.NONE, state=tkinter.DISABLED)
+        self.text.pack(fill=tkinter.X, expand=1)
+        self.text.bind('<MouseWheel>', lambda event: self.on_scroll('scroll', -event.delta // 120, 'units'))
+        for level, colour in self.colours.items():
+            self.text.tag_configure(str(level), foreground=colour)
+
+        log.listener = self.schedule_refresh
+
+    def schedule_refresh(self):
+        # many lines added at once are drawn once
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            self.text.after_idle(self.refresh)
+
+    def on_scroll(self, command, value, units=None):
+        last_first = max(0, len(self.log) - self.height)
+        if command == 'moveto':
+            first = int(float(value) * len(self.log))
+        else:
+            first = self.first + int(value) * (self.height if units == 'pages' else 1)
+
+        self.first = min(max(0, first), last_first)
+        self.follow = self.first == last_first
+        self.refresh()
+
+    def refresh(self):
+        self.refresh_pending = False
+        count = len(self.log)
+        if self.follow:
+            self.first = max(0, count - self.height)
+
+        self.text.config(state=tkinter.NORMAL)
+        self.text.delete(1.0, tkinter.END)
+        for level, line in self.log.window(self.first, self.height):
+            self.text.insert(tkinter.END, line + '\n', str(level))
+
+        self.text.config(state=tkinter.DISABLED)
+        if count:
+            self.scrollbar.set(self.first / count, min(1.0, (self.first + self.height) / count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
 
 class ModalDialog:
@@ -0,0 +1,710 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import random
+import tracemalloc
+
+import jsonpickle
+
+import faketree
+import inputlog
+import instrument
+import locators
+import scenario
+import scenarioview
+import scenariotools
+import treesnapshot
+import uiatools
+import userinput
+
+
+def _fake_scenario(actions, actions_per_step=50, elements=1000):
+    provider = faketree.FakeProvider.generate(elements)
+    rnd = random.Random(3)
+    tree = uiatools.ItemPathTree(provider)
+    sc = scenario.Scenario()
+    for num in range(actions):
+        if num % actions_per_step == 0:
+            sc.steps.append(scenario.Step(f'Step {len(sc.steps) + 1}'))
+
+        path = uiatools.ItemPath(rnd.choice(provider.items), tree=tree)
+        if num % 3:
+            action = scenario.ClickAction(path)
+        else:
+            action = scenario.KeyboardAction(path, 'text{VK_RETURN}')
+
+        sc.steps[-1].actions.append(action)
+
+    return sc
+
+
+def _legacy_code_gen(sc: scenario.Scenario, debug=False):
+    """ Generator with string concatenation as it was before CodeGenContext """
+    ctx = scenario.CodeGenContext(debug)
+    for one in sc.steps:
+        one.globals_gen(ctx)
+
+    code = '""" Code generated by uiatestbuilder """\n\n'
+    code += ''.join(ctx.imports)
+    code += '\n\n' if len(ctx.imports) else ''
+    code += ''.join(ctx.variables)
+    code += '\n\n' if len(ctx.variables) else ''
+    code += '\n\n'.join(ctx.functions)
+    code += '\n\n' if len(ctx.functions) else ''
+    steps_code = []
+    for step in sc.steps:
+        step_code = f'def {step.get_func_name()}():\n'
+        step_code += '    ' + f'""" {step.name} """\n\n'
+        last = len(step.actions) - 1
+        for num, one in enumerate(step.actions):
+            step_code += '    ' + f'# {one.__class__.__name__} {one.id}\n'
+            step_code += ''.join('    ' + line + '\n' for line in (one.code_gen(debug) + one.end_gen(debug)).splitlines())
+            if num != last:
+                step_code += '\n'
+        steps_code.append(step_code)
+
+    code += '\n\n'.join(steps_code)
+    code += '\n\n'
+    code += 'def main():\n'
+    try_block = len(ctx.exception_handlers) > 0
+    if try_block:
+        code += '    try:\n'
+
+    for one in sc.steps:
+        code += ('        ' if try_block else '    ') + f'{one.get_func_name()}()\n'
+
+    code += ''.join(('    ' + line + '\n' for one in ctx.exception_handlers for line in one.splitlines()))
+    code += '\n\n'
+    code += "if __name__ == '__main__':\n"
+    code += '    main()\n'
+    return code
+
+
+def _legacy_identical_items_index(provider, item):
+    top_item = provider.top_level_parent(item)
+    all_items = [top_item, ] + provider.descendants(top_item)
+    identical = []
+    info = provider.element_info(item)
+    for one in all_items:
+        if provider.element_info(one).name == info.name:
+            if provider.element_info(one).automation_id == info.automation_id:
+                if provider.element_info(one).control_type == info.control_type:
+                    if provider.element_info(one).control_id == info.control_id:
+                        identical.append(one)
+
+    if len(identical) < 2:
+        return None
+
+    for index, one in enumerate(identical):
+        if provider.rectangle(one) == provider.rectangle(item):
+            return index
+
+
+def _measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class _CountingWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+
+def bench_identical_items_index(sizes=(1000, 10000, 50000), lookups=200):
+    results = []
+    for size in sizes:
+        provider = faketree.FakeProvider.generate(size)
+        targets = random.Random(1).sample(provider.items, min(lookups, len(provider.items)))
+
+        legacy_time, legacy = _measure(lambda: [_legacy_identical_items_index(provider, one) for one in targets])
+        index = uiatools.IdenticalItemsIndex(provider)
+        build_time, _ = _measure(index.get_index, targets[0])
+        lookup_time, indexed = _measure(lambda: [index.get_index(one) for one in targets])
+        assert legacy == indexed
+
+        results.append({
+            'elements': size,
+            'legacy_lookup_us': legacy_time / len(targets) * 1e6,
+            'snapshot_build_ms': build_time * 1e3,
+            'indexed_lookup_us': lookup_time / len(targets) * 1e6,
+        })
+
+    return results
+
+
+def bench_hit_test_cache(sizes=(100, 1000, 5000), lookups=10000):
+    results = []
+    rnd = random.Random(0)
+    for size in sizes:
+        # form of controls 40x20 laid out in rows of 50
+        cache = uiatools.HitTestCache()
+        rects = [faketree.FakeRect(40 * (num % 50), 20 * (num // 50), 40 * (num % 50) + 40, 20 * (num // 50) + 20)
+                 for num in range(size)]
+        fill_time, _ = _measure(lambda: [cache.add(None, one) for one in rects])
+        points = [(rnd.randrange(2000), rnd.randrange(20 * (size // 50 + 1))) for _ in range(lookups)]
+        lookup_time, found = _measure(lambda: [cache.find(x, y) for x, y in points])
+
+        results.append({
+            'rectangles': size,
+            'fill_us': fill_time / size * 1e6,
+            'lookup_us': lookup_time / lookups * 1e6,
+            'hit_ratio': sum(1 for one in found if one) / lookups,
+        })
+
+    return results
+
+
+def bench_item_path_tree(sizes=(1000, 10000, 50000), paths=2000):
+    results = []
+    for size in sizes:
+        provider = faketree.FakeProvider.generate(size)
+        rnd = random.Random(2)
+        targets = [rnd.choice(provider.items) for _ in range(paths)]
+
+        plain_time, plain = _measure(lambda: [uiatools.ItemPath(one, provider=provider) for one in targets])
+        tree = uiatools.ItemPathTree(provider)
+        tree_time, interned = _measure(lambda: [uiatools.ItemPath(one, tree=tree) for one in targets])
+        assert [str(one) for one in plain] == [str(one) for one in interned]
+
+        def capture():
+            capture_tree = uiatools.ItemPathTree(provider)
+            return [uiatools.ItemPath(one, tree=capture_tree) for one in targets]
+
+        results.append({
+            'elements': size,
+            'paths': paths,
+            'plain_path_us': plain_time / paths * 1e6,
+            'plain_records': sum(len(one.path) for one in plain),
+            'tree_path_us': tree_time / paths * 1e6,
+            'tree_records': len({id(record) for one in interned for record in one.path}),
+            'tree_peak_kb': _peak_memory(capture) / 1024,
+        })
+
+    return results
+
+
+def bench_tree_shapes(shapes=((2, 30, 0.2), (4, 6, 0.2), (8, 3, 0.2), (4, 6, 0.8)), scans=2000):
+    """ Path capture by Scanner on synthetic trees of (depth, fan_out, duplicate_ratio) """
+    results = []
+    for depth, fan_out, duplicate_ratio in shapes:
+        provider = faketree.FakeProvider(*faketree.synthetic_tree(depth, fan_out, duplicate_ratio))
+        scanner = uiatools.Scanner(provider=provider)
+        rnd = random.Random(4)
+        points = [faketree.cell_center(rnd.randrange(len(provider.items))) for _ in range(scans)]
+
+        def scan():
+            for x, y in points:
+                scanner.scan_at(x, y)
+                # every scan resolves the item anew as after a click
+                scanner.invalidate_cache()
+
+        scan_time, _ = _measure(scan)
+        results.append({
+            'depth': depth,
+            'fan_out': fan_out,
+            'duplicate_ratio': duplicate_ratio,
+            'elements': len(provider.items),
+            'scan_us': scan_time / scans * 1e6,
+        })
+
+    return results
+
+
+def bench_code_gen(sizes=(1000, 10000, 50000), debug=True):
+    results = []
+    for size in sizes:
+        sc = _fake_scenario(size)
+        legacy_time, legacy = _measure(_legacy_code_gen, sc, debug)
+        out = io.StringIO()
+        stream_time, _ = _measure(sc.write_code, out, debug)
+        assert out.getvalue() == legacy
+        del legacy, out
+
+        legacy_peak = _peak_memory(_legacy_code_gen, sc, debug)
+        del sc
+
+        # peaks of the first build, code of actions is not cached yet; build() to a file does not cache it
+        sc = _fake_scenario(size)
+        streaming_peak = _peak_memory(sc.write_code, _CountingWriter(), debug, False)
+        cached_peak = _peak_memory(sc.write_code, _CountingWriter(), debug, True)
+        results.append({
+            'actions': size,
+            'legacy_ms': legacy_time * 1e3,
+            'streaming_ms': stream_time * 1e3,
+            'legacy_peak_kb': legacy_peak / 1024,
+            'streaming_peak_kb': streaming_peak / 1024,
+            'cached_peak_kb': cached_peak / 1024,
+        })
+
+    return results
+
+
+def _code_caches(sc: scenario.Scenario):
+    return [one.code_cache for step in sc.steps for one in step.actions]
+
+
+def bench_incremental_code_gen(sizes=(2000, 20000), debug=True):
+    results = []
+    for size in sizes:
+        sc = _fake_scenario(size)
+        full_time, _ = _measure(sc.write_code, _CountingWriter(), debug)
+
+        # Tune dialog parses text of every record of the path, only the item itself is edited
+        path = sc.steps[len(sc.steps) // 2].actions[0].item_path.path
+        texts = [record.to_enum_str() + '\n' for record in path]
+        texts[-1] = texts[-1].replace('\ntitle=', '\n-title=')
+        caches = _code_caches(sc)
+        for record, text in zip(path, texts):
+            record.from_enum_str(text)
+
+        tuned_time, _ = _measure(sc.write_code, _CountingWriter(), debug)
+        tuned_actions = sum(before is not after for before, after in zip(caches, _code_caches(sc)))
+        del sc.steps[0].actions[0]
+        deleted_time, _ = _measure(sc.write_code, _CountingWriter(), debug)
+
+        results.append({
+            'actions': size,
+            'full_ms': full_time * 1e3,
+            'after_tune_ms': tuned_time * 1e3,
+            'actions_generated_after_tune': tuned_actions,
+            'after_delete_ms': deleted_time * 1e3,
+        })
+
+    return results
+
+
+def bench_serialization(sizes=(1000, 10000, 50000), legacy_limit=10000):
+    """ jsonpickle reference is measured up to `legacy_limit` actions """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_path = os.path.join(tmp_dir, 'legacy.uiasc')
+        path = os.path.join(tmp_dir, 'scenario.uiasc')
+        for size in sizes:
+            sc = _fake_scenario(size)
+            row = {'actions': size}
+
+            if size <= legacy_limit:
+                def legacy_save():
+                    with open(legacy_path, 'w', encoding='utf-8') as file:
+                        file.write(jsonpickle.encode(sc))
+
+                legacy_save_time, _ = _measure(legacy_save)
+                legacy_load_time, _ = _measure(scenariotools.load, legacy_path)
+                row.update({
+                    'jsonpickle_kb': os.path.getsize(legacy_path) / 1024,
+                    'jsonpickle_save_ms': legacy_save_time * 1e3,
+                    'jsonpickle_load_ms': legacy_load_time * 1e3,
+                })
+
+            save_time, _ = _measure(scenariotools.save, sc, path)
+            load_time, loaded = _measure(scenariotools.load, path)
+            assert loaded.code_gen() == sc.code_gen()
+            del loaded
+
+            row.update({
+                'uiasc_kb': os.path.getsize(path) / 1024,
+                'uiasc_save_ms': save_time * 1e3,
+                'uiasc_load_ms': load_time * 1e3,
+                'uiasc_save_peak_kb': _peak_memory(scenariotools.save, sc, path) / 1024,
+                'uiasc_load_peak_kb': _peak_memory(scenariotools.load, path) / 1024,
+            })
+            results.append(row)
+
+    return results
+
+
+def _legacy_locate(sc: scenario.Scenario, index):
+    count = 0
+    for step in sc.steps:
+        if index == count:
+            return step, None
+        else:
+            n = len(step.actions)
+            if index <= count + n:
+                for action in step.actions:
+                    count += 1
+                    if index == count:
+                        return step, action
+            else:
+                count += n + 1
+
+
+def bench_scenario_view(sizes=(1000, 10000, 50000), operations=500):
+    results = []
+    for size in sizes:
+        sc = _fake_scenario(size)
+        view = scenarioview.ScenarioView(sc)
+        rnd = random.Random(4)
+        rows = [rnd.randrange(view.row_count()) for _ in range(operations)]
+
+        legacy_time, legacy = _measure(lambda: [_legacy_locate(sc, one) for one in rows])
+        locate_time, located = _measure(lambda: [view.locate(one)[:2] for one in rows])
+        assert legacy == located
+
+        steps = [rnd.choice(sc.steps) for _ in range(operations)]
+        insert_time, _ = _measure(lambda: [view.add_action(one, scenario.SleepAction(1)) for one in steps])
+
+        def delete():
+            # first actions of random steps
+            for one in steps:
+                view.remove_action(view.step_row(one) + 1)
+
+        delete_time, _ = _measure(delete)
+        view_check = scenarioview.ScenarioView(sc)
+        assert view_check.offsets == view.offsets
+
+        results.append({
+            'actions': size,
+            'legacy_select_us': legacy_time / operations * 1e6,
+            'select_us': locate_time / operations * 1e6,
+            'insert_us': insert_time / operations * 1e6,
+            'delete_us': delete_time / operations * 1e6,
+            'view_peak_kb': _peak_memory(scenarioview.ScenarioView, sc) / 1024,
+        })
+
+    return results
+
+
+def _click_stream(clicks, double_click_time, seed=5):
+    """ Offsets of clicks in bursts with expected (double) classification of every emitted click """
+    rnd = random.Random(seed)
+    offsets = []
+    expected = []
+    now = 0.0
+    while len(offsets) < clicks:
+        double = rnd.random() < 0.4
+        offsets.append(now)
+        if double:
+            offsets.append(now + double_click_time * rnd.uniform(0.2, 0.6))
+        expected.append(double)
+        now = offsets[-1] + double_click_time * rnd.uniform(1.5, 3)
+
+    return offsets, expected
+
+
+def bench_click_stream(clicks=(100, 400), double_click_time=0.05):
+    results = []
+    for count in clicks:
+        offsets, expected = _click_stream(count, double_click_time)
+        classified = []
+        deadlines = []
+        latencies = []
+
+        def on_click(button, double, context):
+            if not double:
+                # single click can be reported at the deadline at the earliest
+                latencies.append(time.monotonic() - deadlines[context])
+            classified.append((context, double))
+
+        handler = userinput.MouseInputHandler(on_click, lambda: len(deadlines) - 1,
+                                              double_click_time=double_click_time)
+        threads_before = threading.active_count()
+        max_threads = threads_before
+        start = time.monotonic()
+        for num, offset in enumerate(offsets):
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            timestamp = time.monotonic()
+            if not num or offset - offsets[num - 1] > double_click_time:
+                deadlines.append(timestamp + double_click_time)
+            handler.on_left_click(timestamp)
+            max_threads = max(max_threads, threading.active_count())
+
+        time.sleep(double_click_time * 3)
+        assert [double for context, double in sorted(classified)] == expected
+
+        results.append({
+            'clicks': len(offsets),
+            'double_click_ms': double_click_time * 1e3,
+            'mean_single_latency_ms': sum(latencies) / len(latencies) * 1e3,
+            'max_single_latency_ms': max(latencies) * 1e3,
+            'extra_threads': max_threads - threads_before,
+        })
+
+    return results
+
+
+def bench_input_replay(sizes=(1000, 10000), elements=1000):
+    results = []
+    provider = faketree.FakeProvider.generate(elements)
+    for size in sizes:
+        events = inputlog.synthetic_events(size, provider)
+        log = io.BytesIO()
+        writer = inputlog.InputLogWriter(log)
+        for one in events:
+            writer.write_event(*one)
+
+        log.seek(0)
+        stats, rec = inputlog.replay_on_fake_tree(inputlog.read_events(log), elements)
+        stats['log_bytes'] = len(log.getvalue())
+        results.append(stats)
+
+    return results
+
+
+def _recorded_scenario(provider, actions, seed=7):
+    """ Click on random items of the fake tree with found_index captured as the recorder does """
+    rnd = random.Random(seed)
+    index = uiatools.IdenticalItemsIndex(provider)
+    tree = uiatools.ItemPathTree(provider)
+    sc = scenario.Scenario()
+    step = scenario.Step('Step 1')
+    sc.add_step(step)
+    for num in range(actions):
+        sc.add_action(step, scenario.ClickAction(uiatools.ItemPath(rnd.choice(provider.items), index, tree=tree)))
+
+    return sc
+
+
+def _resolve_all(snapshot: treesnapshot.TreeSnapshot, sc: scenario.Scenario):
+    """ Number of paths resolved in the snapshot as they are searched at run """
+    resolved = 0
+    for action in sc.steps[0].actions:
+        try:
+            snapshot.resolve([one.search_criteria() for one in action.item_path.path[1:]])
+            resolved += 1
+        except treesnapshot.LocatorError:
+            pass
+
+    return resolved
+
+
+def bench_locator_optimizer(sizes=(1000, 10000, 50000), actions=1000):
+    results = []
+    for size in sizes:
+        provider = faketree.FakeProvider.generate(size)
+        sc = _recorded_scenario(provider, actions)
+        capture_seconds, snapshot = _measure(treesnapshot.TreeSnapshot.capture, provider)
+        resolve_before, resolved_before = _measure(_resolve_all, snapshot, sc)
+        optimize_seconds, result = _measure(locators.LocatorOptimizer(snapshot).optimize, sc)
+        resolve_after, resolved_after = _measure(_resolve_all, snapshot, sc)
+        results.append({
+            'elements': size,
+            'actions': actions,
+            'capture_ms': capture_seconds * 1e3,
+            'optimize_ms': optimize_seconds * 1e3,
+            'resolved_before': resolved_before,
+            'resolved_after': resolved_after,
+            'keys_per_action_before': result.keys_before / actions,
+            'keys_per_action_after': result.keys_after / actions,
+            'records_per_action_before': result.records_before / actions,
+            'records_per_action_after': result.records_after / actions,
+            'snapshot_resolve_before_us': resolve_before / actions * 1e6,
+            'snapshot_resolve_after_us': resolve_after / actions * 1e6,
+        })
+
+    return results
+
+
+def bench_locator_validation(actions=(1000, 10000), elements=50000):
+    results = []
+    provider = faketree.FakeProvider.generate(elements)
+    with tempfile.TemporaryDirectory() as dir_path:
+        file_path = os.path.join(dir_path, 'tree.uiats')
+        treesnapshot.TreeSnapshot.capture(provider).save(file_path)
+        snapshot = treesnapshot.TreeSnapshot.load(file_path)
+        for size in actions:
+            sc = _recorded_scenario(provider, size)
+            recorded_seconds, recorded = _measure(locators.validate, sc, snapshot)
+            locators.LocatorOptimizer(snapshot).optimize(sc)
+            optimized_seconds, optimized = _measure(locators.validate, sc, snapshot)
+            results.append({
+                'elements': elements,
+                'actions': size,
+                'recorded_validate_ms': recorded_seconds * 1e3,
+                'recorded_resolved': recorded.resolved,
+                'recorded_problems': len(recorded.problems),
+                'optimized_validate_ms': optimized_seconds * 1e3,
+                'optimized_resolved': optimized.resolved,
+            })
+
+        del snapshot
+
+    return results
+
+
+def _chain(snapshot: treesnapshot.TreeSnapshot, num):
+    """ Path criteria of the element by auto_id from its top level window, found_index where it is needed """
+    elements = []
+    while num > 0:
+        elements.append(num)
+        num = snapshot.parents[num]
+
+    elements.reverse()
+    path = [{'control_type': snapshot.value(elements[0], 'control_type')}]
+    for anchor, num in zip(elements, elements[1:]):
+        criteria = {'auto_id': snapshot.value(num, 'auto_id')}
+        found_index = snapshot.found_index(anchor, criteria, num)
+        if found_index is not None:
+            criteria['found_index'] = found_index
+        path.append(criteria)
+
+    return path
+
+
+def bench_tree_snapshot(sizes=(10000, 100000, 300000), lookups=1000):
+    results = []
+    rnd = random.Random(11)
+    with tempfile.TemporaryDirectory() as dir_path:
+        for size in sizes:
+            provider = faketree.FakeProvider.generate(size)
+            capture_seconds, snapshot = _measure(treesnapshot.TreeSnapshot.capture, provider)
+            file_path = os.path.join(dir_path, f'{size}.uiats')
+            save_seconds, _ = _measure(snapshot.save, file_path)
+            del snapshot, provider
+            load_seconds, mapped = _measure(treesnapshot.TreeSnapshot.load, file_path)
+            top = mapped.children(0)[0]
+            targets = [rnd.randrange(2, size + 2) for _ in range(lookups)]
+            values = [mapped.value(num, 'auto_id') for num in targets]
+            find_seconds, _ = _measure(lambda: [mapped.find(top, {'auto_id': one}) for one in values])
+            paths = [_chain(mapped, num) for num in targets]
+            resolve_seconds, _ = _measure(lambda: [mapped.resolve(one) for one in paths])
+            file_size = os.path.getsize(file_path)
+            results.append({
+                'elements': size,
+                'capture_ms': capture_seconds * 1e3,
+                'save_ms': save_seconds * 1e3,
+                'file_kb': file_size / 1024,
+                'bytes_per_element': file_size / size,
+                'load_ms': load_seconds * 1e3,
+                'find_us': find_seconds / lookups * 1e6,
+                'resolve_us': resolve_seconds / lookups * 1e6,
+            })
+            del mapped
+
+    return results
+
+
+def _print_results(name, results):
+    print(name)
+    for row in results:
+        print('    ' + ', '.join(f'{k}={v:.1f}' if isinstance(v, float) else f'{k}={v}' for k, v in row.items()))
+
+
+# name, function, arguments of the quick run
+BENCHMARKS = (
+    ('identical_items_index', bench_identical_items_index, {'sizes': (1000, 10000)}),
+    ('hit_test_cache', bench_hit_test_cache, {'sizes': (100, 1000)}),
+    ('item_path_tree', bench_item_path_tree, {'sizes': (1000, 10000)}),
+    ('tree_shapes', bench_tree_shapes, {'shapes': ((2, 30, 0.2), (4, 6, 0.2))}),
+    ('code_gen', bench_code_gen, {'sizes': (1000, 10000)}),
+    ('incremental_code_gen', bench_incremental_code_gen, {'sizes': (2000, )}),
+    ('serialization', bench_serialization, {'sizes': (1000, 10000)}),
+    ('scenario_view', bench_scenario_view, {'sizes': (1000, 10000)}),
+    ('click_stream', bench_click_stream, {'clicks': (100, )}),
+    ('input_replay', bench_input_replay, {'sizes': (1000, )}),
+    ('locator_optimizer', bench_locator_optimizer, {'sizes': (1000, 10000)}),
+    ('tree_snapshot', bench_tree_snapshot, {'sizes': (10000, 100000)}),
+    ('locator_validation', bench_locator_validation, {'actions': (1000, ), 'elements': 10000}),
+)
+
+# metrics of the reference implementations are not checked for regressions
+_REFERENCE_PREFIXES = ('legacy_', 'jsonpickle_')
+_COST_SUFFIXES = ('_ms', '_us', '_kb')
+
+
+def run(names=None, quick=False, verbose=True):
+    results = {}
+    for name, func, quick_args in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        results[name] = func(**quick_args) if quick else func()
+        if verbose:
+            _print_results(name, results[name])
+
+    return results
+
+
+def _is_cost(metric):
+    return metric.endswith(_COST_SUFFIXES) and not metric.startswith(_REFERENCE_PREFIXES)
+
+
+def _row_key(row):
+    # parameters of the row are the values which are not costs
+    return tuple((k, v) for k, v in row.items() if not k.endswith(_COST_SUFFIXES) and not isinstance(v, float))
+
+
+def compare(baseline, current, threshold=0.25, min_value=1.0):
+    """ Costs which grew more than `threshold` times, values below `min_value` are noise """
+    regressions = []
+    for name, rows in current.items():
+        baseline_rows = {_row_key(row): row for row in baseline.get(name, [])}
+        for row in rows:
+            baseline_row = baseline_rows.get(_row_key(row))
+            if not baseline_row:
+                continue
+
+            for metric, value in row.items():
+                old = baseline_row.get(metric)
+                if not _is_cost(metric) or old is None or max(old, value) < min_value:
+                    continue
+
+                if value > old * (1 + threshold):
+                    params = ', '.join(f'{k}={v}' for k, v in _row_key(row))
+                    regressions.append(f'{name} ({params}): {metric} {old:.1f} -> {value:.1f}')
+
+    return regressions
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmarks of uiatestbuilder hot paths on synthetic data')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--output', help='write results to json file')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative growth of costs')
+    parser.add_argument('--trace', help='write chrome trace json of the run and print summary of spans')
+    args = parser.parse_args()
+
+    instrument.enable(bool(args.trace))
+    results = run(args.names, args.quick)
+    if args.trace:
+        instrument.enable(False)
+        instrument.export_chrome_trace(args.trace)
+        print(instrument.summary())
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'quick': args.quick,
+                'results': results,
+            }, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+
+        regressions = compare(baseline, results, args.threshold)
+        for one in regressions:
+            print('REGRESSION ' + one)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,283 @@
+from typing import Any, Optional
+
+import instrument
+
+try:
+    import pywinauto
+    from pywinauto import handleprops
+    from pywinauto import win32functions
+    from pywinauto.uia_defines import IUIA
+    from pywinauto.uia_element_info import UIAElementInfo
+    from pywinauto.controls.uiawrapper import UIAWrapper
+    from pywinauto.win32structures import RECT
+    from comtypes import COMError
+    import pyautogui
+except ImportError:
+    # recorder paths run on a fake tree without the live desktop
+    pywinauto = handleprops = win32functions = pyautogui = None
+    IUIA = UIAElementInfo = UIAWrapper = RECT = None
+
+    class COMError(Exception):
+        pass
+
+
+# element is an opaque object of the provider
+Element = Any
+
+
+class ElementProvider:
+    """ Element tree for the recorder: hit testing, navigation, rectangles and properties.
+
+        element_info() returns object with attributes of pywinauto element_info used in paths: name,
+        automation_id, control_type, control_id, runtime_id, handle, class_name, process_id, visible, enabled,
+        framework_id, rectangle. ancestors() and descendant_infos() return elements along with their infos and
+        child_rectangles() returns rectangles of all children, so a backend can fetch properties of many elements
+        at once. """
+
+    # exceptions raised when the element is gone
+    errors = ()
+
+    def root(self) -> Element:
+        """ The desktop, parent of top level windows """
+        raise RuntimeError('not implemented')
+
+    def from_point(self, x, y) -> Element:
+        raise RuntimeError('not implemented')
+
+    def cursor_position(self):
+        raise RuntimeError('not implemented')
+
+    def window_key(self):
+        """ Changes when another window comes to the foreground or the foreground window is moved """
+        raise RuntimeError('not implemented')
+
+    def parent(self, element: Element) -> Optional[Element]:
+        raise RuntimeError('not implemented')
+
+    def children(self, element: Element):
+        raise RuntimeError('not implemented')
+
+    def descendants(self, element: Element, title=None, control_type=None):
+        raise RuntimeError('not implemented')
+
+    def top_level_parent(self, element: Element) -> Element:
+        raise RuntimeError('not implemented')
+
+    def rectangle(self, element: Element):
+        raise RuntimeError('not implemented')
+
+    def element_info(self, element: Element):
+        raise RuntimeError('not implemented')
+
+    def draw_outline(self, element: Element, colour, rect):
+        pass
+
+    def ancestors(self, element: Element):
+        """ (element, info) of the element and its parents up to the root, lazily """
+        while element:
+            yield element, self.element_info(element)
+            element = self.parent(element)
+
+    def descendant_infos(self, element: Element, title=None, control_type=None):
+        """ (element, info) of the descendants """
+        return [(one, self.element_info(one)) for one in self.descendants(element, title, control_type)]
+
+    def child_rectangles(self, element: Element):
+        return [self.rectangle(one) for one in self.children(element)]
+
+    def subtree(self, element: Element):
+        """ (info, parent) of the element and its descendants in depth-first order, parent is the position of
+            the parent in the output, -1 for the element """
+        stack = [(element, -1)]
+        position = 0
+        while stack:
+            one, parent = stack.pop()
+            yield self.element_info(one), parent
+            stack.extend((child, position) for child in reversed(self.children(one)))
+            position += 1
+
+
+class CachedElementInfo:
+    """ Properties of UIA element taken from its cache, other attributes are read from the live element """
+
+    def __init__(self, element):
+        uia = IUIA().UIA_dll
+        self.live_info = UIAElementInfo(element)
+        self.name = element.CachedName
+        self.automation_id = element.CachedAutomationId
+        self.control_type = IUIA().known_control_type_ids.get(element.CachedControlType)
+        self.runtime_id = element.GetCachedPropertyValue(uia.UIA_RuntimeIdPropertyId)
+        self.handle = element.CachedNativeWindowHandle
+        self.class_name = element.CachedClassName
+        self.process_id = element.CachedProcessId
+        self.visible = not element.CachedIsOffscreen
+        self.enabled = bool(element.CachedIsEnabled)
+        self.framework_id = element.CachedFrameworkId
+        rect = element.CachedBoundingRectangle
+        self.rectangle = RECT(rect.left, rect.top, rect.right, rect.bottom)
+
+    @property
+    def control_id(self):
+        # window property, not a part of UIA cache
+        return handleprops.controlid(self.handle) if self.handle else None
+
+    def __getattr__(self, name):
+        return getattr(self.live_info, name)
+
+
+class _LazyWrapper:
+    """ UIAWrapper of a UIA element created on first use, most elements of ancestors() and descendant_infos()
+        are only looked at through their cached infos """
+
+    def __init__(self, element):
+        self.element = element
+        self.wrapper = None
+
+    def __getattr__(self, name):
+        if self.wrapper is None:
+            instrument.count('uia.wrappers')
+            self.wrapper = UIAWrapper(UIAElementInfo(self.element))
+
+        return getattr(self.wrapper, name)
+
+
+class UiaProvider(ElementProvider):
+    """ Live desktop through pywinauto UIA backend, elements are wrappers """
+
+    errors = (COMError, )
+
+    # properties of elements in paths, all of them come in one round trip per element
+    CACHED_PROPERTIES = ('Name', 'AutomationId', 'ControlType', 'RuntimeId', 'NativeWindowHandle', 'ClassName',
+                         'ProcessId', 'IsOffscreen', 'IsEnabled', 'FrameworkId', 'BoundingRectangle')
+
+    def __init__(self):
+        self.desktop = pywinauto.Desktop(backend='uia')
+        self.cache_request = self._cache_request()
+        # whole subtree of control view in one call, children are taken from the cache
+        self.subtree_request = self._cache_request()
+        self.subtree_request.TreeScope = IUIA().tree_scope['subtree']
+        self.rectangle_request = IUIA().iuia.CreateCacheRequest()
+        self.rectangle_request.AddProperty(IUIA().UIA_dll.UIA_BoundingRectanglePropertyId)
+
+    def _cache_request(self):
+        request = IUIA().iuia.CreateCacheRequest()
+        for one in self.CACHED_PROPERTIES:
+            request.AddProperty(getattr(IUIA().UIA_dll, f'UIA_{one}PropertyId'))
+
+        return request
+
+    def root(self):
+        return UIAWrapper(UIAElementInfo())
+
+    def from_point(self, x, y):
+        instrument.count('uia.from_point')
+        return self.desktop.from_point(x, y)
+
+    def cursor_position(self):
+        return pyautogui.position()
+
+    def window_key(self):
+        handle = win32functions.GetForegroundWindow()
+        rect = handleprops.rectangle(handle)
+        return handle, (rect.left, rect.top, rect.right, rect.bottom)
+
+    def parent(self, element):
+        instrument.count('uia.parent')
+        return element.parent()
+
+    def children(self, element):
+        instrument.count('uia.children')
+        return element.children()
+
+    def descendants(self, element, title=None, control_type=None):
+        instrument.count('uia.descendants')
+        criteria = {}
+        if title is not None:
+            criteria['title'] = title
+        if control_type is not None:
+            criteria['control_type'] = control_type
+
+        return element.descendants(**criteria)
+
+    def top_level_parent(self, element):
+        instrument.count('uia.top_level_parent')
+        return element.top_level_parent()
+
+    def rectangle(self, element):
+        instrument.count('uia.rectangle')
+        return element.rectangle()
+
+    def element_info(self, element):
+        instrument.count('uia.element_info')
+        return element.element_info
+
+    def draw_outline(self, element, colour, rect):
+        element.draw_outline(colour=colour, thickness=2, rect=rect)
+
+    def ancestors(self, element):
+        # every step navigates to the parent and fetches its cached properties in a single call
+        walker = IUIA().iuia.ControlViewWalker
+        cached = element.element_info.element.BuildUpdatedCache(self.cache_request)
+        instrument.count('uia.build_cache')
+        while cached:
+            yield _LazyWrapper(cached), CachedElementInfo(cached)
+            instrument.count('uia.parent_build_cache')
+            cached = walker.GetParentElementBuildCache(cached, self.cache_request)
+
+    def descendant_infos(self, element, title=None, control_type=None):
+        iuia = IUIA().iuia
+        condition = IUIA().true_condition
+        if title is not None:
+            condition = iuia.CreateAndCondition(
+                condition, iuia.CreatePropertyCondition(IUIA().UIA_dll.UIA_NamePropertyId, title))
+        if control_type is not None:
+            condition = iuia.CreateAndCondition(
+                condition, iuia.CreatePropertyCondition(IUIA().UIA_dll.UIA_ControlTypePropertyId,
+                                                        IUIA().known_control_types[control_type]))
+
+        instrument.count('uia.find_all_build_cache')
+        found = element.element_info.element.FindAllBuildCache(IUIA().tree_scope['descendants'], condition,
+                                                              self.cache_request)
+        out = []
+        for i in range(found.Length):
+            one = found.GetElement(i)
+            out.append((_LazyWrapper(one), CachedElementInfo(one)))
+
+        return out
+
+    def child_rectangles(self, element):
+        # a container may have hundreds of children, their rectangles come in one call
+        instrument.count('uia.find_all_build_cache')
+        found = element.element_info.element.FindAllBuildCache(IUIA().tree_scope['children'], IUIA().true_condition,
+                                                              self.rectangle_request)
+        out = []
+        for i in range(found.Length):
+            rect = found.GetElement(i).CachedBoundingRectangle
+            out.append(RECT(rect.left, rect.top, rect.right, rect.bottom))
+
+        return out
+
+    def subtree(self, element):
+        instrument.count('uia.build_cache')
+        stack = [(element.element_info.element.BuildUpdatedCache(self.subtree_request), -1)]
+        position = 0
+        while stack:
+            cached, parent = stack.pop()
+            yield CachedElementInfo(cached), parent
+            children = cached.GetCachedChildren()
+            # null array for an element without children
+            if children:
+                stack.extend((children.GetElement(i), position) for i in reversed(range(children.Length)))
+            position += 1
+
+
+_uia_provider = None
+
+
+def default_provider() -> ElementProvider:
+    """ Shared UIA provider, created on first use """
+    global _uia_provider
+    if _uia_provider is None:
+        _uia_provider = UiaProvider()
+
+    return _uia_provider
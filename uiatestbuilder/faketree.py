@@ -0,0 +1,138 @@
+import random
+import collections
+
+import elementtree
+
+
+FakeRect = collections.namedtuple('FakeRect', 'left top right bottom')
+
+# items are laid out in rows of cells, so every item is found by a point of its own cell
+CELL_WIDTH = 40
+CELL_HEIGHT = 20
+ROW_SIZE = 50
+
+
+class FakeElementInfo:
+    def __init__(self, name, automation_id, control_type, control_id, runtime_id, rectangle=None):
+        self.name = name
+        self.automation_id = automation_id
+        self.control_type = control_type
+        self.control_id = control_id
+        self.runtime_id = (runtime_id, )
+        self.handle = runtime_id
+        self.class_name = control_type
+        self.process_id = 1
+        self.visible = True
+        self.enabled = True
+        self.framework_id = 'Win32'
+        self.rectangle = rectangle
+
+
+class FakeElement:
+    def __init__(self, info: FakeElementInfo, parent, rect):
+        self.element_info = info
+        self.parent = parent
+        self.rect = info.rectangle = rect
+        self.children = []
+        if parent:
+            parent.children.append(self)
+
+
+def cell_rect(num):
+    left = CELL_WIDTH * (num % ROW_SIZE)
+    top = CELL_HEIGHT * (num // ROW_SIZE)
+    return FakeRect(left, top, left + CELL_WIDTH, top + CELL_HEIGHT)
+
+
+def cell_center(num):
+    rect = cell_rect(num)
+    return (rect.left + rect.right) // 2, (rect.top + rect.bottom) // 2
+
+
+def fake_tree(count, fan_out=10, duplicate_ratio=0.2, seed=0):
+    """ Desktop with one top level window of `count` descendants filled level by level """
+    rnd = random.Random(seed)
+    control_types = ('Button', 'Edit', 'Text', 'Pane', 'Group', 'ListItem')
+    desktop = FakeElement(FakeElementInfo('Desktop', '', 'Pane', 0, 0), None, FakeRect(0, 0, 0, 0))
+    top = FakeElement(FakeElementInfo('Window', '', 'Window', 0, 1), desktop, FakeRect(0, 0, 0, 0))
+    items = []
+    parents = [top, ]
+    for num in range(count):
+        if items and rnd.random() < duplicate_ratio:
+            origin = rnd.choice(items).element_info
+            info = FakeElementInfo(origin.name, origin.automation_id, origin.control_type, origin.control_id, num + 2)
+        else:
+            info = FakeElementInfo(f'item {num}', f'auto_{num}', rnd.choice(control_types), num, num + 2)
+
+        parent = parents[num // fan_out] if num // fan_out < len(parents) else parents[-1]
+        item = FakeElement(info, parent, cell_rect(num))
+        items.append(item)
+        parents.append(item)
+
+    return desktop, items
+
+
+def synthetic_tree(depth, fan_out=10, duplicate_ratio=0.2, seed=0):
+    """ Complete tree of `depth` levels under the top level window """
+    return fake_tree(sum(fan_out ** level for level in range(1, depth + 1)), fan_out, duplicate_ratio, seed)
+
+
+class FakeProvider(elementtree.ElementProvider):
+    """ In-memory tree, the top level window is always in the foreground """
+
+    errors = (LookupError, )
+
+    def __init__(self, desktop: FakeElement, items):
+        self.desktop = desktop
+        self.items = items
+        self.position = (0, 0)
+
+    @classmethod
+    def generate(cls, count, fan_out=10, duplicate_ratio=0.2, seed=0):
+        return cls(*fake_tree(count, fan_out, duplicate_ratio, seed))
+
+    def root(self):
+        return self.desktop
+
+    def from_point(self, x, y):
+        num = (y // CELL_HEIGHT) * ROW_SIZE + x // CELL_WIDTH
+        if 0 <= x < CELL_WIDTH * ROW_SIZE and 0 <= num < len(self.items):
+            return self.items[num]
+
+        return self.desktop.children[0]
+
+    def cursor_position(self):
+        return self.position
+
+    def window_key(self):
+        return 'fake', id(self.desktop)
+
+    def parent(self, element: FakeElement):
+        return element.parent
+
+    def children(self, element: FakeElement):
+        return list(element.children)
+
+    def descendants(self, element: FakeElement, title=None, control_type=None):
+        out = []
+        stack = list(reversed(element.children))
+        while stack:
+            one = stack.pop()
+            if (title is None or one.element_info.name == title) and \
+                    (control_type is None or one.element_info.control_type == control_type):
+                out.append(one)
+            stack.extend(reversed(one.children))
+
+        return out
+
+    def top_level_parent(self, element: FakeElement):
+        while element.parent and element.parent.parent:
+            element = element.parent
+
+        return element
+
+    def rectangle(self, element: FakeElement):
+        return element.rect
+
+    def element_info(self, element: FakeElement):
+        return element.element_info
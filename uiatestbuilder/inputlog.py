@@ -0,0 +1,153 @@
+import sys
+import time
+import random
+import struct
+import collections
+from typing import Iterable
+
+import faketree
+import recorder
+import userinput
+
+
+MAGIC = b'UIAIN'
+VERSION = 1
+
+_HEADER = struct.Struct('<5sB')
+# kind, timestamp (time.monotonic), cursor x, cursor y, size of keys
+_RECORD = struct.Struct('<Bdiih')
+_KIND_CODES = {userinput.UserInput.MOUSE_LEFT: 1, userinput.UserInput.MOUSE_RIGHT: 2, userinput.UserInput.KEYBOARD: 3}
+_KINDS = {code: kind for kind, code in _KIND_CODES.items()}
+
+InputEvent = collections.namedtuple('InputEvent', 'kind timestamp x y key')
+
+
+class InputLogFormatError(Exception):
+    pass
+
+
+class InputLogWriter:
+    """ Raw input events in binary records, pressed keys of keyboard events are joined by tab """
+
+    def __init__(self, file):
+        self.file = file
+        self.file.write(_HEADER.pack(MAGIC, VERSION))
+
+    def write_event(self, kind, timestamp, x=0, y=0, key=None):
+        keys = '\t'.join(key).encode('utf-8') if key else b''
+        self.file.write(_RECORD.pack(_KIND_CODES[kind], timestamp, x, y, len(keys)))
+        self.file.write(keys)
+
+
+def read_events(file) -> Iterable[InputEvent]:
+    header = file.read(_HEADER.size)
+    if len(header) != _HEADER.size or _HEADER.unpack(header)[0] != MAGIC:
+        raise InputLogFormatError('Not an input log')
+
+    version = _HEADER.unpack(header)[1]
+    if version > VERSION:
+        raise InputLogFormatError(f'Unsupported input log version: {version}')
+
+    while True:
+        record = file.read(_RECORD.size)
+        if len(record) < _RECORD.size:
+            # end of file or record torn by crash
+            return
+
+        code, timestamp, x, y, size = _RECORD.unpack(record)
+        keys = file.read(size).decode('utf-8')
+        key = keys.split('\t') if keys else None
+        yield InputEvent(_KINDS[code], timestamp, x, y, key)
+
+
+def synthetic_events(count, provider: faketree.FakeProvider, double_click_time=0.3, seed=0):
+    """ Clicks on random items of the fake tree, some of them double, and typing with Rcontrol brackets """
+    rnd = random.Random(seed)
+    now = 0.0
+    events = []
+    while len(events) < count:
+        x, y = faketree.cell_center(rnd.randrange(len(provider.items)))
+        choice = rnd.random()
+        if choice < 0.5:
+            events.append(InputEvent(userinput.UserInput.MOUSE_LEFT, now, x, y, None))
+            if choice < 0.15:
+                now += double_click_time / 3
+                events.append(InputEvent(userinput.UserInput.MOUSE_LEFT, now, x, y, None))
+        elif choice < 0.6:
+            events.append(InputEvent(userinput.UserInput.MOUSE_RIGHT, now, x, y, None))
+        else:
+            events.append(InputEvent(userinput.UserInput.KEYBOARD, now, x, y, ['Rcontrol']))
+            for char in 'text':
+                now += 0.05
+                events.append(InputEvent(userinput.UserInput.KEYBOARD, now, x, y, [char.upper()]))
+
+            now += 0.05
+            events.append(InputEvent(userinput.UserInput.KEYBOARD, now, x, y, ['Rcontrol']))
+
+        now += double_click_time * 2
+
+    return events
+
+
+class InputReplay:
+    """ Feeds recorded events into the recorder without hooks and the scanning thread.
+
+        Timestamps keep the recorded spacing, so clicks are classified the same at any speed. `speed` None
+        replays as fast as possible, 1 - at the recorded pace. """
+
+    def __init__(self, rec: recorder.Recorder, speed=None):
+        self.rec = rec
+        self.speed = speed
+
+    def run(self, events: Iterable[InputEvent]):
+        latencies = []
+        start = time.monotonic()
+        first = None
+        for event in events:
+            first = event.timestamp if first is None else first
+            timestamp = start + event.timestamp - first
+            if self.speed:
+                delay = start + (event.timestamp - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            begin = time.perf_counter()
+            # single click is reported before the events which came after its double click time
+            self.rec.input.mouse_input_handler.flush(timestamp)
+            self.rec.scanner.scan_at(event.x, event.y)
+            self.rec.input.handle_event(event.kind, timestamp, event.x, event.y, event.key)
+            latencies.append(time.perf_counter() - begin)
+
+        self.rec.input.mouse_input_handler.flush()
+        seconds = time.monotonic() - start
+        latencies.sort()
+        count = len(latencies)
+        return {
+            'events': count,
+            'actions': self.rec.action_queue.qsize(),
+            'events_per_s': count / seconds if seconds else 0.0,
+            'mean_latency_us': sum(latencies) / count * 1e6 if count else 0.0,
+            'p95_latency_us': latencies[int(count * 0.95)] * 1e6 if count else 0.0,
+            'max_latency_us': latencies[-1] * 1e6 if count else 0.0,
+        }
+
+
+def replay_on_fake_tree(events: Iterable[InputEvent], elements=1000, speed=None):
+    rec = recorder.Recorder(provider=faketree.FakeProvider.generate(elements))
+    return InputReplay(rec, speed).run(events), rec
+
+
+def _main():
+    """ inputlog.py [log_path] - replays the log or synthetic events on the fake tree """
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as file:
+            events = list(read_events(file))
+    else:
+        events = synthetic_events(10000, faketree.FakeProvider.generate(1000))
+
+    stats, rec = replay_on_fake_tree(events)
+    print(', '.join(f'{k}={v:.1f}' if isinstance(v, float) else f'{k}={v}' for k, v in stats.items()))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import threading
+import functools
+
+
+# checked by every probe, probes cost one function call while instrumentation is off
+enabled = False
+
+_events = []
+_counters = {}
+_lock = threading.Lock()
+_start = time.perf_counter()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.begin = 0.0
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _add_event(self.name, self.begin, time.perf_counter() - self.begin, self.args)
+        return False
+
+
+def enable(on=True):
+    """ Starts collecting from scratch or stops collecting, collected data is kept until the next start """
+    global enabled
+    if on:
+        reset()
+
+    enabled = on
+
+
+def reset():
+    global _start
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _start = time.perf_counter()
+
+
+def span(name, **args):
+    """ with span('name'): ... - duration of the block """
+    return _Span(name, args) if enabled else _NULL_SPAN
+
+
+def complete(name, seconds, **args):
+    """ Span of `seconds` measured by the caller, ended now """
+    if enabled:
+        _add_event(name, time.perf_counter() - seconds, seconds, args)
+
+
+def count(name, value=1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def traced(name):
+    """ Decorator, call of the function is a span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _add_event(name, begin, seconds, args):
+    # list.append is atomic, spans of all threads go to one list
+    _events.append((name, begin, seconds, threading.get_ident(), args))
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def export_chrome_trace(file_path):
+    """ Trace event json for chrome://tracing and Perfetto """
+    pid = os.getpid()
+    trace = []
+    for name, begin, seconds, tid, args in list(_events):
+        trace.append({'name': name, 'ph': 'X', 'ts': (begin - _start) * 1e6, 'dur': seconds * 1e6,
+                      'pid': pid, 'tid': tid, 'args': args})
+
+    now = (time.perf_counter() - _start) * 1e6
+    for name, value in counters().items():
+        trace.append({'name': name, 'ph': 'C', 'ts': now, 'pid': pid, 'args': {'value': value}})
+
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file)
+
+
+def summary():
+    """ Table of spans by total time and counters """
+    stats = {}
+    for name, begin, seconds, tid, args in list(_events):
+        entry = stats.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    lines = [f'{"span":<32} {"count":>8} {"total ms":>10} {"mean ms":>10} {"max ms":>10}']
+    for name, (calls, total, longest) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        lines.append(f'{name:<32} {calls:>8} {total * 1e3:>10.2f} {total / calls * 1e3:>10.3f} {longest * 1e3:>10.3f}')
+
+    values = counters()
+    if values:
+        lines.append('')
+        lines.append(f'{"counter":<32} {"value":>8}')
+        for name, value in sorted(values.items()):
+            lines.append(f'{name:<32} {value:>8}')
+
+    return '\n'.join(lines)
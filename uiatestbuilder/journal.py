@@ -0,0 +1,267 @@
+import os
+import copy
+import glob
+import json
+import time
+import shutil
+import threading
+from typing import Optional
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+import scenario
+import scenariotools
+import uiatools
+
+
+JOURNAL_FORMAT_NAME = 'uiasc-journal'
+JOURNAL_FORMAT_VERSION = 1
+
+
+def _lock(path):
+    """ Opened file locked for the lifetime of the process or None if another process holds the lock """
+    file = open(path, 'a+')
+    file.seek(0)
+    try:
+        if msvcrt:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+
+    return file
+
+
+class Journal:
+    """ Append-only log of scenario changes with autosave snapshot.
+
+        State is the snapshot file plus journal files applied in order of their sequence numbers.
+        Compaction switches appends to a new journal file, writes snapshot in background and then removes
+        journal files included into it. Replay is idempotent, so crash at any point loses nothing.
+
+        Every instance of the editor writes to its own session directory, `<session>.lock` next to it is locked
+        while the instance runs. Sessions which are not locked are left by crashed instances, recover() takes
+        the latest of them. """
+
+    def __init__(self, dir_path, compact_every=1000):
+        self.sessions_path = os.path.join(dir_path, 'sessions')
+        self.compact_every = compact_every
+        self.dir_path = None
+        self.snapshot_path = None
+        self.lock_file = None
+        # session of a crashed instance taken by recover(), removed when the recovered state is saved here
+        self.recovered = None
+        self.sc = None
+        self.seq = 0
+        self.file = None
+        self.writer = None
+        self.lines = 0
+        self.compaction_thread = None
+
+    def _open_session(self):
+        if self.dir_path:
+            return
+
+        os.makedirs(self.sessions_path, exist_ok=True)
+        name = f'{os.getpid()}.{time.time_ns()}'
+        # lock goes first, so a session directory without locked lock file is always abandoned
+        self.lock_file = _lock(os.path.join(self.sessions_path, name + '.lock'))
+        self.dir_path = os.path.join(self.sessions_path, name)
+        os.makedirs(self.dir_path)
+        self.snapshot_path = os.path.join(self.dir_path, 'autosave.uiasc')
+
+    def _abandoned_sessions(self):
+        """ [(session path, lock file)] of sessions whose instances are not running, the latest first """
+        sessions = []
+        for path in glob.glob(os.path.join(self.sessions_path, '*.lock')):
+            session_path = path[:-len('.lock')]
+            if session_path == self.dir_path:
+                continue
+
+            lock_file = _lock(path)
+            if lock_file is None:
+                continue
+
+            if not os.path.isdir(session_path):
+                # instance exited after its session was removed
+                lock_file.close()
+                os.remove(path)
+                continue
+
+            sessions.append((os.path.getmtime(session_path), session_path, lock_file))
+
+        sessions.sort(reverse=True)
+        return [(session_path, lock_file) for mtime, session_path, lock_file in sessions]
+
+    @staticmethod
+    def _remove_session(session_path, lock_file):
+        shutil.rmtree(session_path, ignore_errors=True)
+        lock_file.close()
+        try:
+            os.remove(session_path + '.lock')
+        except OSError:
+            pass
+
+    def _journal_path(self, seq, session_path=None):
+        return os.path.join(session_path or self.dir_path, f'journal.{seq}.uiaj')
+
+    def _journal_seqs(self, session_path=None):
+        seqs = []
+        for path in glob.glob(os.path.join(session_path or self.dir_path, 'journal.*.uiaj')):
+            try:
+                seqs.append(int(os.path.basename(path).split('.')[1]))
+            except ValueError:
+                pass
+
+        return sorted(seqs)
+
+    def recover(self) -> Optional[scenario.Scenario]:
+        """ Returns scenario left by the latest crashed session or None, sessions of running instances are
+            not touched """
+        self._open_session()
+        for session_path, lock_file in self._abandoned_sessions():
+            if self.recovered is None:
+                sc = self._read_session(session_path)
+                if sc is not None:
+                    self.recovered = (session_path, lock_file)
+                    continue
+
+                self._remove_session(session_path, lock_file)
+            else:
+                # left for the next start
+                lock_file.close()
+
+        return self._read_session(self.recovered[0]) if self.recovered else None
+
+    def _read_session(self, session_path) -> Optional[scenario.Scenario]:
+        snapshot_path = os.path.join(session_path, 'autosave.uiasc')
+        seqs = self._journal_seqs(session_path)
+        if not seqs and not os.path.exists(snapshot_path):
+            return None
+
+        sc = scenariotools.load(snapshot_path) if os.path.exists(snapshot_path) else None
+        reader = scenariotools.ScenarioReader(sc)
+        for seq in seqs:
+            # records and key sets are indexed per journal file
+            reader = scenariotools.ScenarioReader(reader.sc)
+            with open(self._journal_path(seq, session_path), encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        line = json.loads(line)
+                    except json.JSONDecodeError:
+                        # line torn by crash
+                        break
+
+                    if isinstance(line, list):
+                        reader.apply(line)
+
+        return reader.sc
+
+    def start(self, sc: scenario.Scenario):
+        """ Starts journal of `sc`, previous session is dropped after the snapshot of `sc` is written """
+        self.sc = sc
+        self._open_session()
+        self.seq = max(self._journal_seqs(), default=0)
+        self.compact(wait=True)
+        if self.recovered:
+            # the recovered scenario, if it is kept, is in the snapshot of this session now
+            self._remove_session(*self.recovered)
+            self.recovered = None
+
+    def compact(self, wait=False):
+        if self.compaction_thread and self.compaction_thread.is_alive():
+            if not wait:
+                return
+
+            self.compaction_thread.join()
+
+        # new changes go to the next journal, the snapshot takes shallow copy of the current state
+        old_seqs = self._journal_seqs()
+        self._open(self.seq + 1)
+        snapshot = scenario.Scenario()
+        for step in self.sc.steps:
+            step_copy = copy.copy(step)
+            step_copy.actions = list(step.actions)
+            snapshot.steps.append(step_copy)
+
+        self.compaction_thread = threading.Thread(target=self._write_snapshot, args=(snapshot, old_seqs))
+        self.compaction_thread.start()
+        if wait:
+            self.compaction_thread.join()
+
+    def _write_snapshot(self, snapshot: scenario.Scenario, old_seqs):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            writer = scenariotools.ScenarioWriter(file)
+            writer.write_header()
+            writer.write_scenario(snapshot)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(tmp_path, self.snapshot_path)
+        for seq in old_seqs:
+            os.remove(self._journal_path(seq))
+
+    def _open(self, seq):
+        if self.file:
+            self.file.close()
+
+        self.seq = seq
+        self.file = open(self._journal_path(seq), 'w', encoding='utf-8')
+        self.writer = scenariotools.ScenarioWriter(self.file)
+        self.writer.write_header(JOURNAL_FORMAT_NAME, JOURNAL_FORMAT_VERSION)
+        self.file.flush()
+        self.lines = 0
+
+    def _written(self):
+        self.file.flush()
+        self.lines += 1
+        if self.lines >= self.compact_every:
+            self.compact()
+
+    def add_step(self, step: scenario.Step):
+        self.writer.write_step(step)
+        self._written()
+
+    def add_action(self, step: scenario.Step, action: scenario.Action):
+        self.writer.write_action(action, step)
+        self._written()
+
+    def remove_step(self, step: scenario.Step):
+        self.writer.write_removed_step(step)
+        self._written()
+
+    def remove_action(self, action: scenario.Action):
+        self.writer.write_removed_action(action)
+        self._written()
+
+    def tune(self, record: uiatools.ItemPathRecord):
+        self.writer.write_tuned_record(record)
+        self._written()
+
+    def set_path(self, action: scenario.ItemAction):
+        self.writer.write_action_path(action)
+        self._written()
+
+    def close(self):
+        """ Clean exit, nothing to recover """
+        if self.compaction_thread:
+            self.compaction_thread.join()
+
+        if self.file:
+            self.file.close()
+            self.file = None
+
+        if self.recovered:
+            self.recovered[1].close()
+            self.recovered = None
+
+        if self.dir_path:
+            self._remove_session(self.dir_path, self.lock_file)
+            self.dir_path = None
@@ -0,0 +1,349 @@
+import sys
+import itertools
+
+import instrument
+import scenario
+import scenariotools
+import treesnapshot
+import uiatools
+
+
+# keys locators are built from and their cost: automation id is set by developers and survives relayout, control
+# type and class name are cheap but rarely unique alone, title changes with data and language, control id with build
+KEY_COSTS = {'auto_id': 1, 'control_type': 1, 'class_name': 2, 'title': 3, 'control_id': 4}
+# keys always disabled by the optimizer, handle is new in every start of the application
+DROPPED_KEYS = ('handle', )
+
+
+def _subsets(keys):
+    """ Non-empty subsets of keys, cheapest first """
+    subsets = [one for size in range(1, len(keys) + 1) for one in itertools.combinations(keys, size)]
+    subsets.sort(key=lambda one: (sum(KEY_COSTS[key] for key in one), len(one)))
+    return subsets
+
+
+def _apply(record: uiatools.ItemPathRecord, keys, found_index):
+    """ Enables exactly `keys` of the optimized keys and found_index if it is not None """
+    props = {}
+    for key, value in record.props.items():
+        name = key.lstrip('-')
+        if name in KEY_COSTS or name in DROPPED_KEYS:
+            enabled = name in keys
+        elif name == 'found_index':
+            enabled = found_index is not None
+            value = found_index if enabled else value
+        else:
+            props[key] = value
+            continue
+
+        props[name if enabled else '-' + name] = value
+
+    record.props = props
+    record.version += 1
+
+
+class OptimizationResult:
+    def __init__(self):
+        self.tuned_records = []
+        # actions with intermediate records dropped
+        self.shortened_actions = []
+        # (step, action, LocatorError or UnsupportedCriteria) of paths not resolved in the snapshot
+        self.failed = []
+        self.keys_before = 0
+        self.keys_after = 0
+        self.records_before = 0
+        self.records_after = 0
+
+    def __str__(self):
+        return f'records tuned {len(self.tuned_records)}, paths shortened {len(self.shortened_actions)}, ' \
+               f'search keys {self.keys_before} -> {self.keys_after}, ' \
+               f'path records {self.records_before} -> {self.records_after}, not resolved {len(self.failed)}'
+
+
+class LocatorOptimizer:
+    """ Tunes path records of a scenario offline against a tree snapshot.
+
+        Every record gets the cheapest set of KEY_COSTS props identifying its element among the elements searched
+        at run, found_index is used only when no set is unique. Intermediate records are dropped from a path when
+        the next record is unique in the deeper search without them. Elements of a path ambiguous at run are
+        identified by the chain of children the recorder captured. Paths not identified in the snapshot are left
+        as they are. """
+
+    def __init__(self, snapshot: treesnapshot.TreeSnapshot, skip_containers=True):
+        self.snapshot = snapshot
+        self.skip_containers = skip_containers
+
+    def _identify(self, records):
+        """ Element numbers of path records """
+        path = [one.search_criteria() for one in records]
+        try:
+            return self.snapshot.resolve(path)
+        except treesnapshot.LocatorError as exc:
+            error = exc
+
+        # every record of a recorded path is a child of the record before it
+        anchor = 0
+        elements = []
+        for record, criteria in zip(records, path):
+            found = self.snapshot.find(anchor, criteria, deep=False)
+            hint = record['found_index']
+            if len(found) > 1 and elements and hint is not None:
+                # found_index captured by the recorder, even disabled, counts identical items of the top level window
+                criteria = dict(criteria)
+                criteria.pop('found_index', None)
+                identical = self.snapshot.find(elements[0], criteria)
+                found = [identical[hint]] if hint < len(identical) and identical[hint] in found else found
+
+            if len(found) != 1:
+                raise error
+
+            anchor = found[0]
+            elements.append(anchor)
+
+        return elements
+
+    @staticmethod
+    def _count(sc: scenario.Scenario):
+        keys = records = 0
+        for step in sc.steps:
+            for action in step.actions:
+                if isinstance(action, scenario.ItemAction):
+                    keys += sum(len(one.search_criteria()) for one in action.item_path.path[1:])
+                    records += len(action.item_path.path) - 1
+
+        return keys, records
+
+    @instrument.traced('locators.optimize')
+    def optimize(self, sc: scenario.Scenario) -> OptimizationResult:
+        result = OptimizationResult()
+        result.keys_before, result.records_before = self._count(sc)
+        resolved = []
+        # record id -> [record, element or None if records resolve differently, {(anchor, deep)}]
+        uses = {}
+        for step in sc.steps:
+            for action in step.actions:
+                if not isinstance(action, scenario.ItemAction):
+                    continue
+
+                records = action.item_path.path[1:]
+                try:
+                    elements = self._identify(records)
+                except (treesnapshot.LocatorError, treesnapshot.UnsupportedCriteria) as exc:
+                    result.failed.append((step, action, exc))
+                    continue
+
+                resolved.append((action, elements))
+                anchor = 0
+                for index, (record, element) in enumerate(zip(records, elements)):
+                    use = uses.setdefault(record.id, [record, element, set()])
+                    if use[1] != element:
+                        use[1] = None
+                    use[2].add((anchor, index > 0))
+                    anchor = element
+
+        for record, element, anchors in uses.values():
+            if element is not None and self._tune(record, element, anchors):
+                result.tuned_records.append(record)
+
+        if self.skip_containers:
+            for action, elements in resolved:
+                path = self._shorten(action.item_path.path, elements)
+                if path:
+                    sc.set_item_path(action, path)
+                    result.shortened_actions.append(action)
+
+        result.keys_after, result.records_after = self._count(sc)
+        instrument.count('locators.tuned', len(result.tuned_records))
+        return result
+
+    def _tune(self, record: uiatools.ItemPathRecord, element, anchors):
+        """ Returns True if the record is changed """
+        criteria = record.search_criteria()
+        base = {key: value for key, value in criteria.items()
+                if key not in KEY_COSTS and key not in DROPPED_KEYS and key != 'found_index'}
+        try:
+            self.snapshot.find(0, base, deep=False)
+        except treesnapshot.UnsupportedCriteria:
+            return False
+
+        # keys of captured values the element still has
+        keys = []
+        for key in KEY_COSTS:
+            try:
+                value = record[key]
+            except KeyError:
+                continue
+
+            if value is not None and value != '' and value == self.snapshot.value(element, key):
+                keys.append(key)
+
+        if not keys:
+            return False
+
+        # elements matching a single key around an anchor the record is searched from, fetched on first use
+        anchors = list(anchors)
+        found_by_key = {}
+
+        def matching(position, subset):
+            sets = []
+            for key in subset:
+                found = found_by_key.get((position, key))
+                if found is None:
+                    anchor, deep = anchors[position]
+                    found = found_by_key[(position, key)] = \
+                        set(self.snapshot.find(anchor, dict(base, **{key: record[key]}), deep))
+
+                sets.append(found)
+
+            return set.intersection(*sets)
+
+        chosen = None
+        found_index = None
+        for subset in _subsets(keys):
+            if all(matching(position, subset) == {element} for position in range(len(anchors))):
+                chosen = subset
+                break
+
+        if chosen is None:
+            if len(anchors) != 1:
+                return False
+
+            # the least ambiguous set, element is told apart by its position in document order
+            found, chosen = min(((matching(0, subset), subset) for subset in _subsets(keys)),
+                                key=lambda one: len(one[0]))
+            found_index = sorted(found).index(element)
+
+        current = tuple(key for key in KEY_COSTS if key in criteria)
+        if set(current) == set(chosen) and criteria.get('found_index') == found_index and \
+                not any(key in criteria for key in DROPPED_KEYS):
+            return False
+
+        _apply(record, chosen, found_index)
+        return True
+
+    def _shorten(self, path, elements):
+        """ Path without intermediate records the next record does not need, None if nothing is dropped """
+        records = path[1:]
+        # the top level window is searched among windows only, it stays along with the item itself
+        kept = list(range(len(records)))
+        dropped = True
+        while dropped and len(kept) > 2:
+            # a record dropped later in the sweep may let an earlier one go in the next sweep
+            dropped = False
+            anchor = elements[kept[0]]
+            out = [kept[0]]
+            for pos in range(1, len(kept) - 1):
+                following = kept[pos + 1]
+                criteria = records[following].search_criteria()
+                if 'found_index' not in criteria and self.snapshot.find(anchor, criteria) == [elements[following]]:
+                    dropped = True
+                    continue
+
+                out.append(kept[pos])
+                anchor = elements[kept[pos]]
+
+            out.append(kept[-1])
+            kept = out
+
+        if len(kept) == len(records):
+            return None
+
+        return [path[0]] + [records[index] for index in kept]
+
+
+class LocatorProblem:
+    """ Record not matching exactly one element when it is searched from the same element by all `actions` """
+
+    def __init__(self, record: uiatools.ItemPathRecord, error):
+        self.record = record
+        # LocatorNotFound, LocatorAmbiguous or UnsupportedCriteria
+        self.error = error
+        # [(step, action)]
+        self.actions = []
+
+    def problem(self):
+        if isinstance(self.error, treesnapshot.LocatorAmbiguous):
+            return f'has duplicates ({len(self.error.matches)} items match)'
+        if isinstance(self.error, treesnapshot.LocatorNotFound):
+            return 'not found'
+
+        return str(self.error)
+
+    def __str__(self):
+        return f'item "{self.record.friendly_name()}" (item_id "{self.record.id}") {self.problem()}, ' \
+               f'{len(self.actions)} actions'
+
+
+class ValidationReport:
+    def __init__(self):
+        self.actions = 0
+        self.resolved = 0
+        # in order of the first action
+        self.problems = []
+
+    def __str__(self):
+        return f'{self.resolved} of {self.actions} actions resolved, {len(self.problems)} broken locators'
+
+
+@instrument.traced('locators.validate')
+def validate(sc: scenario.Scenario, snapshot: treesnapshot.TreeSnapshot) -> ValidationReport:
+    """ Resolves paths of all actions in the snapshot as they are resolved at run, without running anything.
+
+        Paths share records, every record is searched once per element it is searched from. An action is reported
+        at the first record which does not match exactly one element. """
+    report = ValidationReport()
+    # (anchor, record id) -> element number or LocatorProblem
+    resolved = {}
+    for step in sc.steps:
+        for action in step.actions:
+            if not isinstance(action, scenario.ItemAction):
+                continue
+
+            report.actions += 1
+            anchor = 0
+            for index, record in enumerate(action.item_path.path[1:]):
+                key = (anchor, record.id)
+                found = resolved.get(key)
+                if found is None:
+                    criteria = record.search_criteria()
+                    try:
+                        matches = snapshot.find(anchor, criteria, deep=index > 0)
+                        if len(matches) == 1:
+                            found = matches[0]
+                        else:
+                            cls = treesnapshot.LocatorAmbiguous if matches else treesnapshot.LocatorNotFound
+                            raise cls(f'{len(matches)} elements match {criteria}', index, matches)
+                    except (treesnapshot.LocatorError, treesnapshot.UnsupportedCriteria) as exc:
+                        found = LocatorProblem(record, exc)
+                        report.problems.append(found)
+
+                    resolved[key] = found
+
+                if isinstance(found, LocatorProblem):
+                    found.actions.append((step, action))
+                    break
+
+                anchor = found
+            else:
+                report.resolved += 1
+
+    instrument.count('locators.validated', report.actions)
+    return report
+
+
+def _main():
+    """ locators.py <scenario.uiasc> <snapshot.uiats> - validates locators of the scenario in the snapshot """
+    if len(sys.argv) != 3:
+        print(_main.__doc__)
+        return
+
+    sc = scenariotools.load(sys.argv[1])
+    report = validate(sc, treesnapshot.TreeSnapshot.load(sys.argv[2]))
+    print(report)
+    for one in report.problems:
+        step, action = one.actions[0]
+        print(f'    {one}, first in step "{step.name}" action {step.actions.index(action) + 1}')
+
+
+if __name__ == '__main__':
+    _main()
@@ -1,13 +1,20 @@
 import queue
+from typing import Callable, Optional
 
+import elementtree
 import scenario
 import uiatools
 import userinput
 
 
 class Recorder:
-    def __init__(self):
-        self.scanner = uiatools.Scanner()
+    def __init__(self, action_listener: Optional[Callable[[], None]] = None,
+                 item_path_listener: Optional[Callable[[], None]] = None,
+                 provider: Optional[elementtree.ElementProvider] = None):
+        """ Listeners are called from recorder threads when an action is queued and when hovered item changes.
+            `provider` replaces the live UIA desktop, see faketree.FakeProvider """
+        self.scanner = uiatools.Scanner(item_path_listener, provider)
+        self.action_listener = action_listener
 
         mih = userinput.MouseInputHandler(self._on_mouse_click, self.scanner.get_item_path)
         kih = userinput.KeyboardInputHandler(self._on_key_press)
@@ -18,31 +25,45 @@ class Recorder:
         self.keyboard_item = None
         self.is_running = False
 
-    def start(self):
+    def start(self, event_log=None):
+        """ Raw input events are written to `event_log` (inputlog.InputLogWriter) if it is given """
         if not self.is_running:
             self.action_queue = queue.Queue()
             self.scanner.start()
-            self.input.start()
+            self.input.start(event_log)
             self.is_running = True
 
     def stop(self):
         if self.is_running:
             self.input.stop()
+            # the last click is the one on the stop button
+            self.input.mouse_input_handler.cancel()
             self.scanner.stop()
             self.is_running = False
 
+    def _put_action(self, action):
+        self.action_queue.put(action)
+        if self.action_listener:
+            self.action_listener()
+
     def _on_mouse_click(self, button, double, item_path):
-        self.action_queue.put(scenario.ClickAction(item_path, button, double))
+        # click can change the layout of the window
+        self.scanner.invalidate_cache()
+        self._put_action(scenario.ClickAction(item_path, button, double))
 
     def _on_key_press(self, keys):
         if keys == ['Rcontrol']:
             if self.keyboard_buffer:
-                self.action_queue.put(scenario.KeyboardAction(self.keyboard_item, self.keyboard_buffer))
+                self._put_action(scenario.KeyboardAction(self.keyboard_item, self.keyboard_buffer))
                 self.keyboard_buffer = ''
             else:
                 self.keyboard_item = self.scanner.get_item_path()
         else:
             self.keyboard_buffer += uiatools.kb_keys_hook_to_uia(keys)
 
+    def reset_paths(self):
+        """ Called when the scenario is replaced, not while recording """
+        self.scanner.reset_paths()
+
     def get_current_item_path(self):
         return self.scanner.get_item_path()
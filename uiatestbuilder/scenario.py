@@ -1,3 +1,6 @@
+import io
+
+import instrument
 import uiatools
 import tools
 
@@ -6,79 +9,95 @@ def _indent(n=1):
     return ' ' * 4 * n
 
 
-class Globals:
-    imports = []
-    variables = []
-    functions = []
-    exception_handlers = []
+class CodeGenContext:
+    """ Globals collected for one build, code of actions is cached in them only if `cache_code` is set """
 
-    @staticmethod
-    def _append_unique(list_, value):
-        if value not in list_:
-            list_.append(value)
+    def __init__(self, debug=False, cache_code=True):
+        self.debug = debug
+        self.cache_code = cache_code
+        # dicts are used as ordered sets
+        self.imports = {}
+        self.variables = {}
+        self.functions = {}
+        self.exception_handlers = {}
 
-    @staticmethod
-    def add_import(code):
-        Globals._append_unique(Globals.imports, code)
+    def add_import(self, code):
+        self.imports[code] = None
 
-    @staticmethod
-    def add_variable(code):
-        Globals._append_unique(Globals.variables, code)
+    def add_variable(self, code):
+        self.variables[code] = None
 
-    @staticmethod
-    def add_function(code):
-        Globals._append_unique(Globals.functions, code)
+    def add_function(self, code):
+        self.functions[code] = None
 
-    @staticmethod
-    def add_exception_handler(code):
-        Globals._append_unique(Globals.exception_handlers, code)
+    def add_exception_handler(self, code):
+        self.exception_handlers[code] = None
 
 
 class Action:
     def __init__(self):
         self.id = tools.generate_id()
+        self.code_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('code_cache', None)
+        return state
 
-    def globals_gen(self, debug=False):
+    def globals_gen(self, ctx: CodeGenContext):
         raise RuntimeError('not implemented')
 
     def code_gen(self, debug=False):
         raise RuntimeError('not implemented')
 
+    def end_gen(self, debug=False):
+        """ Code placed after the code of the action """
+        return ''
+
+    def code_stamp(self):
+        """ Value that changes whenever generated code of the action changes """
+        return ()
+
+    def block_gen(self, debug=False, cache_code=True):
+        """ Code of the action as it is placed into step function, taken from the cache if it is up to date.
+            New code is kept in the cache only if `cache_code` is set """
+        stamp = (debug, self.code_stamp())
+        cache = getattr(self, 'code_cache', None)
+        if cache is not None and cache[0] == stamp:
+            return cache[1]
+
+        instrument.count('codegen.actions_generated')
+        code = _indent() + f'# {self.__class__.__name__} {self.id}\n'
+        code += ''.join(_indent() + line + '\n'
+                        for line in (self.code_gen(debug) + self.end_gen(debug)).splitlines())
+        self.code_cache = (stamp, code) if cache_code else None
+        return code
+
 
 class ItemAction(Action):
     def __init__(self, item_uia_path: uiatools.ItemPath):
         super().__init__()
         self.item_path = item_uia_path
 
-    def globals_gen(self, debug=False):
-        Globals.add_import('import pywinauto\n')
-        Globals.add_variable("desktop = pywinauto.Desktop(backend='uia', allow_magic_lookup=False)\n")
+    def globals_gen(self, ctx: CodeGenContext):
+        ctx.add_import('import uiaruntime\n')
 
-        if debug:
-            Globals.add_import('from pywinauto.findwindows import ElementAmbiguousError, ElementNotFoundError\n')
-            Globals.add_variable('path_id = 0\n')
-
-            code = 'def set_path_id(_id):\n' + _indent() + 'global path_id\n' + _indent() + 'path_id = _id\n'
-            Globals.add_function(code)
-
-            code = 'except (ElementAmbiguousError, ElementNotFoundError) as exc:\n'
-            code += _indent() + 'exc.path_id = path_id\n'
-            code += _indent() + 'raise exc\n'
-            Globals.add_exception_handler(code)
+    def code_stamp(self):
+        # the desktop record is not in the code
+        return tuple((record.id, record.version) for record in self.item_path.path[1:])
 
     def code_gen(self, debug=False):
-        code = 'item = desktop\n'
+        code = f'item = uiaruntime.find_path({self.id}, (\n'
         for record in self.item_path.path[1:]:
-            if debug:
-                code += f'set_path_id({record.id})\n'
-
-            code += f"item = item.window({record.to_search_str()})\n"
-
-            if debug:
-                code += 'item.is_active()\n'
+            code += _indent() + f'({record.id}, dict({record.to_search_str()})),\n'
 
+        code += '))\n'
         return code
 
+    def end_gen(self, debug=False):
+        # action time of the timing report
+        return f'uiaruntime.end_action({self.id})\n' if debug else ''
+
 
 class ClickAction(ItemAction):
     def __init__(self, item_uia_path: uiatools.ItemPath, mouse_button='left', double_click=False):
@@ -86,6 +105,9 @@ class ClickAction(ItemAction):
         self.mouse_button = mouse_button
         self.double_click = double_click
 
+    def code_stamp(self):
+        return super().code_stamp(), self.mouse_button, self.double_click
+
     def code_gen(self, debug=False):
         code = super().code_gen(debug)
         code += "item.draw_outline(colour='green', thickness=2)\n"
@@ -98,6 +120,9 @@ class KeyboardAction(ItemAction):
         super().__init__(item_uia_path)
         self.keys = keys
 
+    def code_stamp(self):
+        return super().code_stamp(), self.keys
+
     def code_gen(self, debug=False):
         code = super().code_gen(debug)
         code += f"item.type_keys(keys=r'{self.keys}', pause=1)\n"
@@ -109,8 +134,11 @@ class SleepAction(Action):
         super().__init__()
         self.seconds = seconds
 
-    def globals_gen(self, debug=False):
-        Globals.add_import('import time')
+    def globals_gen(self, ctx: CodeGenContext):
+        ctx.add_import('import time\n')
+
+    def code_stamp(self):
+        return self.seconds,
 
     def code_gen(self, debug=False):
         return f'time.sleep({self.seconds})\n'
@@ -122,8 +150,11 @@ class SignalAction(Action):
         self.host = host
         self.port = port
 
-    def globals_gen(self, debug=False):
-        Globals.add_import('import socket')
+    def globals_gen(self, ctx: CodeGenContext):
+        ctx.add_import('import socket\n')
+
+    def code_stamp(self):
+        return self.host, self.port
 
 
 class WaitForSignalAction(SignalAction):
@@ -167,56 +198,168 @@ class Step:
     def get_func_name(self):
         return f'step_{self.id}'
 
-    def globals_gen(self, debug=False):
+    def globals_gen(self, ctx: CodeGenContext):
         for one in self.actions:
-            one.globals_gen(debug)
+            one.globals_gen(ctx)
 
-    def code_gen(self, debug=False):
-        code = f'def {self.get_func_name()}():\n'
-        code += _indent() + f'""" {self.name} """\n\n'
-        last = len(self.actions) - 1
+    def code_stamp(self):
+        return self.name, tuple((one.id, one.code_stamp()) for one in self.actions)
+
+    def write_code(self, out, debug=False, cache_code=True):
+        # code of actions is cached by actions, only changed actions are generated again
+        out.write(f'def {self.get_func_name()}():\n')
+        out.write(_indent() + f'""" {self.name} """\n\n')
         for num, one in enumerate(self.actions):
-            code += _indent() + f'# {one.__class__.__name__} {one.id}\n'
-            code += ''.join(_indent() + line + '\n' for line in one.code_gen(debug).splitlines())
-            if num != last:
-                code += '\n'
+            if num:
+                out.write('\n')
+            out.write(one.block_gen(debug, cache_code))
 
-        return code
+    def code_gen(self, debug=False):
+        out = io.StringIO()
+        self.write_code(out, debug)
+        return out.getvalue()
+
+
+class IdRegistry:
+    """ Index of scenario objects by id """
+
+    def __init__(self):
+        self.steps = {}
+        self.actions = {}
+        # record id -> [record, number of actions using it], records are shared between paths
+        self.records = {}
+
+    def add_step(self, step: Step):
+        tools.reserve_id(step.id)
+        self.steps[step.id] = step
+        for one in step.actions:
+            self.add_action(step, one)
+
+    def remove_step(self, step: Step):
+        for one in step.actions:
+            self.remove_action(one)
+
+        self.steps.pop(step.id, None)
+
+    def add_action(self, step: Step, action: Action):
+        tools.reserve_id(action.id)
+        self.actions[action.id] = (step, action)
+        if isinstance(action, ItemAction):
+            for record in action.item_path.path:
+                tools.reserve_id(record.id)
+                self.records.setdefault(record.id, [record, 0])[1] += 1
+
+    def remove_action(self, action: Action):
+        self.actions.pop(action.id, None)
+        if isinstance(action, ItemAction):
+            for record in action.item_path.path:
+                entry = self.records.get(record.id)
+                if entry:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del self.records[record.id]
+
+    def find_step(self, step_id):
+        return self.steps.get(step_id)
+
+    def find_action(self, action_id):
+        """ Returns (step, action) or (None, None) """
+        return self.actions.get(action_id, (None, None))
+
+    def find_record(self, record_id):
+        entry = self.records.get(record_id)
+        return entry[0] if entry else None
 
 
 class Scenario:
     def __init__(self):
         self.steps = []
+        self.registry = IdRegistry()
 
-    # def add_step(self, step: Step):
-    #     self.steps.append(step)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('registry', None)
+        return state
 
-    def code_gen(self, debug=False):
-        code = '""" Code generated by uiatestbuilder """\n\n'
+    def reindex(self):
+        """ Builds id registry of loaded scenario """
+        self.registry = IdRegistry()
+        for one in self.steps:
+            self.registry.add_step(one)
+
+    def add_step(self, step: Step):
+        self.steps.append(step)
+        self.registry.add_step(step)
+
+    def remove_step(self, step: Step, index=None):
+        if index is None:
+            self.steps.remove(step)
+        else:
+            del self.steps[index]
+
+        self.registry.remove_step(step)
+
+    def add_action(self, step: Step, action: Action):
+        step.actions.append(action)
+        self.registry.add_action(step, action)
+
+    def remove_action(self, step: Step, action: Action, index=None):
+        if index is None:
+            step.actions.remove(action)
+        else:
+            del step.actions[index]
+
+        self.registry.remove_action(action)
+
+    def set_item_path(self, action: ItemAction, path):
+        """ Replaces records of the action path, records no longer used by any action leave the registry """
+        step = self.registry.find_action(action.id)[0]
+        self.registry.remove_action(action)
+        # item path may be shared with other actions of the same item
+        item_path = uiatools.ItemPath()
+        item_path.path = list(path)
+        action.item_path = item_path
+        if step:
+            self.registry.add_action(step, action)
+
+    @instrument.traced('codegen.scenario')
+    def write_code(self, out, debug=False, cache_code=True):
+        ctx = CodeGenContext(debug, cache_code)
         for one in self.steps:
-            one.globals_gen(debug)
-
-        code += ''.join(Globals.imports)
-        code += '\n\n' if len(Globals.imports) else ''
-        code += ''.join(Globals.variables)
-        code += '\n\n' if len(Globals.variables) else ''
-        code += '\n\n'.join(Globals.functions)
-        code += '\n\n' if len(Globals.functions) else ''
-        code += '\n\n'.join((one.code_gen(debug) for one in self.steps))
-        code += '\n\n'
-
-        code += 'def main():\n'
-        try_block = len(Globals.exception_handlers) > 0
-        if try_block :
-            code += _indent() + 'try:\n'
+            one.globals_gen(ctx)
+
+        out.write('""" Code generated by uiatestbuilder """\n\n')
+        for section in (ctx.imports, ctx.variables):
+            if section:
+                out.write(''.join(section))
+                out.write('\n\n')
+
+        if ctx.functions:
+            out.write('\n\n'.join(ctx.functions))
+            out.write('\n\n')
+
+        for num, one in enumerate(self.steps):
+            if num:
+                out.write('\n\n')
+            one.write_code(out, debug, ctx.cache_code)
+
+        out.write('\n\n')
+
+        out.write('def main():\n')
+        try_block = len(ctx.exception_handlers) > 0
+        if try_block:
+            out.write(_indent() + 'try:\n')
 
         for one in self.steps:
-            code += _indent(2 if try_block else 1) + f'{one.get_func_name()}()\n'
+            out.write(_indent(2 if try_block else 1) + f'{one.get_func_name()}()\n')
 
-        code += ''.join((_indent() + line + '\n' for one in Globals.exception_handlers for line in one.splitlines()))
+        out.write(''.join(_indent() + line + '\n' for one in ctx.exception_handlers for line in one.splitlines()))
 
-        code += '\n\n'
-        code += "if __name__ == '__main__':\n"
-        code += _indent() + 'main()\n'
+        out.write('\n\n')
+        out.write("if __name__ == '__main__':\n")
+        out.write(_indent() + 'main()\n')
 
-        return code
+    def code_gen(self, debug=False):
+        out = io.StringIO()
+        self.write_code(out, debug)
+        return out.getvalue()
@@ -1,57 +1,310 @@
-import sys
-import importlib
+import json
+import hashlib
+import linecache
+import itertools
 import traceback
-from typing import Iterable
+from typing import Iterable, Optional
 
 import jsonpickle
-import pywinauto
-from pywinauto.findwindows import ElementAmbiguousError, ElementNotFoundError
 
+import instrument
 import scenario
+import uiatools
+
+try:
+    from pywinauto.findwindows import ElementAmbiguousError, ElementNotFoundError
+    import uiaruntime
+except ImportError:
+    # scenarios are saved, loaded and built without pywinauto, only run_steps needs it
+    uiaruntime = None
+
+    class ElementAmbiguousError(Exception):
+        pass
+
+    class ElementNotFoundError(Exception):
+        pass
+
+
+FORMAT_NAME = 'uiasc'
+# 1 - jsonpickle of the whole scenario, 2 - json lines with shared table of path records
+FORMAT_VERSION = 2
+
+_ACTION_TYPES = {one.__name__: one for one in (
+    scenario.ClickAction,
+    scenario.KeyboardAction,
+    scenario.SleepAction,
+    scenario.WaitForSignalAction,
+    scenario.SendSignalAction,
+)}
+
+
+class ScenarioFormatError(Exception):
+    pass
+
+
+class ScenarioWriter:
+    """ Writes json lines: props key sets "k", records "r", steps "s", actions "a" and, for journals,
+        removals "-s", "-a", tuned records "t" and replaced action paths "p". Key sets and records are written
+        once before first use and referenced by index. """
+
+    def __init__(self, file):
+        self.file = file
+        self.key_sets = {}
+        self.records = {}
+
+    def _line(self, value):
+        self.file.write(json.dumps(value, ensure_ascii=False, separators=(',', ':')))
+        self.file.write('\n')
+
+    def write_header(self, format_name=FORMAT_NAME, version=FORMAT_VERSION):
+        self._line({'format': format_name, 'version': version})
+
+    def _key_set(self, keys):
+        index = self.key_sets.get(keys)
+        if index is None:
+            index = self.key_sets[keys] = len(self.key_sets)
+            self._line(['k', keys])
+
+        return index
+
+    def _record(self, record: uiatools.ItemPathRecord):
+        index = self.records.get(record.id)
+        if index is None:
+            props = record.props
+            keys_index = self._key_set(tuple(props))
+            index = self.records[record.id] = len(self.records)
+            self._line(['r', record.id, keys_index, list(props.values())])
+
+        return index
+
+    def write_step(self, step: scenario.Step):
+        self._line(['s', step.id, step.name])
+
+    def write_action(self, action: scenario.Action, step: Optional[scenario.Step] = None):
+        """ Action belongs to the last written step if `step` is not given """
+        fields = action.__getstate__()
+        del fields['id']
+        path = None
+        if isinstance(action, scenario.ItemAction):
+            path = [self._record(one) for one in fields.pop('item_path').path]
+
+        line = ['a', action.__class__.__name__, action.id, path, fields]
+        if step:
+            line.append(step.id)
+
+        self._line(line)
+
+    def write_scenario(self, sc: scenario.Scenario):
+        for step in sc.steps:
+            self.write_step(step)
+            for action in step.actions:
+                self.write_action(action)
+
+    def write_removed_step(self, step: scenario.Step):
+        self._line(['-s', step.id])
+
+    def write_removed_action(self, action: scenario.Action):
+        self._line(['-a', action.id])
+
+    def write_tuned_record(self, record: uiatools.ItemPathRecord):
+        props = record.props
+        self._line(['t', record.id, self._key_set(tuple(props)), list(props.values())])
+
+    def write_action_path(self, action: scenario.ItemAction):
+        path = [self._record(one) for one in action.item_path.path]
+        self._line(['p', action.id, path])
+
+
+def _make(cls, **fields):
+    obj = cls.__new__(cls)
+    obj.__dict__.update(fields)
+    return obj
+
+
+class ScenarioReader:
+    """ Applies lines written by ScenarioWriter, objects that are already in the scenario are not added again """
+
+    def __init__(self, sc: Optional[scenario.Scenario] = None):
+        self.sc = sc or scenario.Scenario()
+        self.key_sets = []
+        self.records = []
+        self.step = None
+
+    def apply(self, line):
+        kind, *data = line
+        registry = self.sc.registry
+        if kind == 'a':
+            type_name, action_id, path, fields, *step_id = data
+            step = registry.find_step(step_id[0]) if step_id else self.step
+            if step is None or registry.find_action(action_id)[1]:
+                return
+
+            try:
+                cls = _ACTION_TYPES[type_name]
+            except KeyError:
+                raise ScenarioFormatError(f'unknown action type: [{type_name}]')
+
+            if path is not None:
+                item_path = uiatools.ItemPath()
+                item_path.path = [self.records[one] for one in path]
+                fields['item_path'] = item_path
+
+            self.sc.add_action(step, _make(cls, id=action_id, code_cache=None, **fields))
+        elif kind == 'r':
+            record_id, keys_index, values = data
+            record = registry.find_record(record_id)
+            if record is None:
+                props = dict(zip(self.key_sets[keys_index], values))
+                record = _make(uiatools.ItemPathRecord, id=record_id, props=props)
+
+            self.records.append(record)
+        elif kind == 's':
+            step_id, name = data
+            self.step = registry.find_step(step_id)
+            if self.step is None:
+                self.step = _make(scenario.Step, id=step_id, name=name, actions=[])
+                self.sc.add_step(self.step)
+        elif kind == 'k':
+            self.key_sets.append(data[0])
+        elif kind == '-a':
+            step, action = registry.find_action(data[0])
+            if action:
+                self.sc.remove_action(step, action)
+        elif kind == '-s':
+            step = registry.find_step(data[0])
+            if step:
+                self.sc.remove_step(step)
+        elif kind == 't':
+            record_id, keys_index, values = data
+            record = registry.find_record(record_id)
+            if record:
+                record.props = dict(zip(self.key_sets[keys_index], values))
+                record.version += 1
+        elif kind == 'p':
+            action_id, path = data
+            step, action = registry.find_action(action_id)
+            if action:
+                self.sc.set_item_path(action, [self.records[one] for one in path])
+        else:
+            raise ScenarioFormatError(f'unknown line: [{kind}]')
+
+    def read(self, file):
+        for line in file:
+            self.apply(json.loads(line))
+
+        return self.sc
 
 
 def save(sc: scenario.Scenario, file_path):
-    serialize_str = jsonpickle.encode(sc)
     with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(serialize_str)
+        writer = ScenarioWriter(file)
+        writer.write_header()
+        writer.write_scenario(sc)
 
 
 def load(file_path) -> scenario.Scenario:
     with open(file_path, encoding='utf-8') as file:
-        serialize_str = file.read()
+        header = json.loads(file.readline())
+        if header.get('format') != FORMAT_NAME:
+            # version 1, jsonpickle of the whole scenario in one line
+            sc = jsonpickle.unpickler.Unpickler().restore(header)
+            sc.reindex()
+            return sc
 
-    return jsonpickle.decode(serialize_str)
+        if header.get('version', 0) > FORMAT_VERSION:
+            raise ScenarioFormatError(f'unsupported version: [{header.get("version")}]')
+
+        return ScenarioReader().read(file)
 
 
 def build(sc: scenario.Scenario, file_path, debug=False):
     with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(sc.code_gen(debug))
+        # code built to a file is not cached, memory stays flat for any size of the scenario
+        sc.write_code(file, debug, cache_code=False)
+
+
+_CACHE_SIZE = 32
+_code_by_stamp = {}
+_code_by_hash = {}
 
 
-def run_steps(steps: Iterable[scenario.Step]):
+def _cache_put(cache, key, value):
+    cache.pop(key, None)
+    cache[key] = value
+    if len(cache) > _CACHE_SIZE:
+        evicted = cache.pop(next(iter(cache)))
+        # source is kept for tracebacks while any of the caches can run the code
+        if not any(one is evicted for one in itertools.chain(_code_by_hash.values(), _code_by_stamp.values())):
+            linecache.cache.pop(evicted.co_filename, None)
+
+
+@instrument.traced('run.compile')
+def _compile_steps(steps: Iterable[scenario.Step]):
+    stamp = tuple((step.id, step.code_stamp()) for step in steps)
+    code = _code_by_stamp.get(stamp)
+    if code is not None:
+        return code
+
     sc = scenario.Scenario()
     sc.steps = steps
-    module_file = 'hohohho.py'
-    build(sc, module_file, debug=True)
+    source = sc.code_gen(debug=True)
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    code = _code_by_hash.get(source_hash)
+    if code is None:
+        file_name = f'<uiatestbuilder-{source_hash[:12]}>'
+        # keep source for tracebacks
+        linecache.cache[file_name] = (len(source), None, source.splitlines(True), file_name)
+        code = compile(source, file_name, 'exec')
+        _cache_put(_code_by_hash, source_hash, code)
+
+    _cache_put(_code_by_stamp, stamp, code)
+    return code
+
+
+def _traced_step(step: scenario.Step, func):
+    def step_func():
+        with instrument.span('run.step', step=step.name):
+            func()
+
+    return step_func
+
+
+def _trace_find_path(action_id, record_id, seconds, cached):
+    instrument.complete('run.find_path', seconds, action_id=action_id, record_id=record_id, cached=cached)
+
+
+def run_steps(sc: scenario.Scenario, steps: Iterable[scenario.Step], report=None):
+    """ Returns (exception type, exception data), timings of actions go to `report` (uiaruntime.TimingReport) """
+    steps = tuple(steps)
+    tracing = instrument.enabled
+    if tracing:
+        uiaruntime.add_timing_hook(_trace_find_path)
+
     try:
-        module_name = module_file.replace('.py', '')
-        if module_name in sys.modules:
-            module = importlib.reload(sys.modules[module_name])
-        else:
-            module = importlib.import_module(module_name)
+        uiaruntime.reset()
+        uiaruntime.report = report
+        namespace = {'__name__': 'uiatestbuilder_run'}
+        exec(_compile_steps(steps), namespace)
+        if tracing:
+            # main() finds step functions in the namespace at call time
+            for one in steps:
+                namespace[one.get_func_name()] = _traced_step(one, namespace[one.get_func_name()])
 
-        module.main()
+        namespace['main']()
     except (ElementAmbiguousError, ElementNotFoundError) as exc:
         exc_type = 'ElementAmbiguousError' if isinstance(exc, ElementAmbiguousError) else 'ElementNotFoundError'
-        for step in steps:
-            for action in step.actions:
-                if isinstance(action, scenario.ItemAction):
-                    for record in action.item_path.path:
-                        if record.id == exc.path_id:
-                            return exc_type, (step, action, record)
+        step, action = sc.registry.find_action(exc.action_id)
+        record = sc.registry.find_record(exc.path_id)
+        if not step or not record:
+            # scenario changed since the code was generated
+            return 'OtherError', traceback.format_exc()
 
-        assert False
+        return exc_type, (step, action, record)
     except:
         return 'OtherError', traceback.format_exc()
+    finally:
+        uiaruntime.report = None
+        if tracing:
+            uiaruntime.remove_timing_hook(_trace_find_path)
 
     return None, None
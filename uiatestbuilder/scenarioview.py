@@ -0,0 +1,115 @@
+import bisect
+
+import scenario
+
+
+class ScenarioView:
+    """ Rows of the action list: row of a step followed by rows of its actions.
+
+        offsets[i] is the row of the i-th step, so row lookup is a bisect. Insertion and deletion shift
+        offsets of the following steps only. action_indexes maps action id to its index in the step, removal
+        reindexes the following actions of the same step only. """
+
+    def __init__(self, sc: scenario.Scenario):
+        self.sc = sc
+        self.offsets = []
+        self.step_indexes = {}
+        self.action_indexes = {}
+        self.rebuild()
+
+    def rebuild(self):
+        self.offsets = []
+        row = 0
+        for step in self.sc.steps:
+            self.offsets.append(row)
+            row += len(step.actions) + 1
+            self._index_actions(step, 0)
+
+        self._index_steps(0)
+
+    def _index_steps(self, start):
+        for i in range(start, len(self.sc.steps)):
+            self.step_indexes[self.sc.steps[i].id] = i
+
+    def _index_actions(self, step, start):
+        for i in range(start, len(step.actions)):
+            self.action_indexes[step.actions[i].id] = i
+
+    def _shift(self, start, count):
+        offsets = self.offsets
+        for i in range(start, len(offsets)):
+            offsets[i] += count
+
+    def row_count(self):
+        if not self.offsets:
+            return 0
+
+        return self.offsets[-1] + len(self.sc.steps[-1].actions) + 1
+
+    def rows(self):
+        """ (step, action) of every row, action is None for rows of steps """
+        for step in self.sc.steps:
+            yield step, None
+            for action in step.actions:
+                yield step, action
+
+    def locate(self, row):
+        """ Returns (step, action, action index), action is None for row of a step """
+        i = bisect.bisect_right(self.offsets, row) - 1
+        step = self.sc.steps[i]
+        local = row - self.offsets[i]
+        if local == 0:
+            return step, None, None
+
+        return step, step.actions[local - 1], local - 1
+
+    def step_index(self, step: scenario.Step):
+        return self.step_indexes[step.id]
+
+    def step_row(self, step: scenario.Step):
+        return self.offsets[self.step_index(step)]
+
+    def action_index(self, action: scenario.Action):
+        return self.action_indexes[action.id]
+
+    def action_row(self, step: scenario.Step, action: scenario.Action):
+        return self.step_row(step) + self.action_index(action) + 1
+
+    def step_end_row(self, step: scenario.Step):
+        """ Row after the last action of the step """
+        return self.step_row(step) + len(step.actions) + 1
+
+    def add_step(self, step: scenario.Step):
+        """ Appends step, returns its row """
+        row = self.row_count()
+        self.sc.add_step(step)
+        self.offsets.append(row)
+        self.step_indexes[step.id] = len(self.sc.steps) - 1
+        return row
+
+    def add_action(self, step: scenario.Step, action: scenario.Action):
+        """ Appends action to the step, returns its row """
+        row = self.step_end_row(step)
+        self.sc.add_action(step, action)
+        self.action_indexes[action.id] = len(step.actions) - 1
+        self._shift(self.step_index(step) + 1, 1)
+        return row
+
+    def remove_action(self, row):
+        step, action, action_index = self.locate(row)
+        self.sc.remove_action(step, action, action_index)
+        del self.action_indexes[action.id]
+        self._index_actions(step, action_index)
+        self._shift(self.step_index(step) + 1, -1)
+
+    def remove_step(self, row):
+        step, action, action_index = self.locate(row)
+        i = self.step_index(step)
+        self.sc.remove_step(step, i)
+        del self.offsets[i]
+        del self.step_indexes[step.id]
+        for one in step.actions:
+            del self.action_indexes[one.id]
+
+        self._shift(i, -len(step.actions) - 1)
+        self._index_steps(i)
@@ -0,0 +1,48 @@
+import os
+import logging
+import logging.handlers
+import collections
+from typing import Callable, Optional
+
+
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+
+class StatusLog:
+    """ Last `capacity` lines of the status in memory, the full log goes to rotating files """
+
+    def __init__(self, capacity=5000, file_path=None, max_bytes=1024 * 1024, backup_count=3):
+        self.lines = collections.deque(maxlen=capacity)
+        self.listener: Optional[Callable[[], None]] = None
+        self.logger = logging.getLogger('uiatestbuilder.status')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if file_path and not self.logger.handlers:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(file_path, maxBytes=max_bytes,
+                                                           backupCount=backup_count, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.logger.addHandler(handler)
+
+    def add(self, text, level=INFO):
+        self.logger.log(level, text)
+        for line in text.splitlines() or ['']:
+            self.lines.append((level, line))
+
+        if self.listener:
+            self.listener()
+
+    def clear(self):
+        self.lines.clear()
+        if self.listener:
+            self.listener()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def window(self, first, count):
+        """ (level, line) pairs of lines from `first` """
+        lines = self.lines
+        return [lines[i] for i in range(first, min(first + count, len(lines)))]
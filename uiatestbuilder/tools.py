@@ -1,5 +1,22 @@
-import random
+import time
+import threading
+
+
+# started from the current time, so ids of scenarios recorded in different sessions do not collide
+_last_id = int(time.time() * 1000)
+_id_lock = threading.Lock()
 
 
 def generate_id():
-    return random.randint(1, 10**10)
+    """ Unique in the process, ids go up monotonically """
+    global _last_id
+    with _id_lock:
+        _last_id += 1
+        return _last_id
+
+
+def reserve_id(used_id):
+    """ Makes generate_id() never return ids up to `used_id`, for ids loaded from files """
+    global _last_id
+    with _id_lock:
+        _last_id = max(_last_id, used_id)
@@ -0,0 +1,536 @@
+import re
+import os
+import sys
+import mmap
+import array
+import bisect
+import struct
+from typing import Optional
+
+import elementtree
+import instrument
+
+
+MAGIC = b'UIATS'
+VERSION = 1
+
+# element_info attributes kept for every element by kind of stored value
+STRING_COLUMNS = ('name', 'automation_id', 'control_type', 'class_name', 'framework_id')
+INT_COLUMNS = ('control_id', 'handle', 'process_id')
+FLAG_COLUMNS = ('visible', 'enabled')
+COLUMNS = STRING_COLUMNS + INT_COLUMNS + FLAG_COLUMNS
+# stored instead of None
+NO_STRING = -1
+NULL = -2 ** 63
+
+# pywinauto search criteria -> column, the same meaning as in findwindows.find_elements
+CRITERIA_COLUMNS = {'title': 'name', 'auto_id': 'automation_id', 'control_type': 'control_type',
+                    'control_id': 'control_id', 'class_name': 'class_name', 'handle': 'handle',
+                    'process': 'process_id', 'framework_id': 'framework_id'}
+REGEX_CRITERIA = {'title_re': 'name', 'class_name_re': 'class_name'}
+# set by the runtime itself or not filtering elements
+IGNORED_CRITERIA = ('top_level_only', 'backend')
+
+
+def _section_types():
+    types = {'strings.offsets': 'I', 'strings.data': 'B'}
+    types.update({name: 'i' for name in STRING_COLUMNS})
+    types.update({name: 'q' for name in INT_COLUMNS})
+    types.update({name: 'B' for name in FLAG_COLUMNS})
+    types.update({'rects': 'i', 'parents': 'i', 'ends': 'i', 'children.offsets': 'i', 'children': 'i'})
+    for name in STRING_COLUMNS:
+        types.update({f'index.{name}.offsets': 'i', f'index.{name}': 'i'})
+    for name in INT_COLUMNS:
+        types.update({f'index.{name}.values': 'q', f'index.{name}.offsets': 'i', f'index.{name}': 'i'})
+
+    return types
+
+
+# name -> array typecode, in order of the file
+SECTIONS = _section_types()
+
+# magic, version, number of elements, then (offset, size in bytes) of every section
+_HEADER = struct.Struct('<5sB2xQ')
+_SECTION = struct.Struct('<QQ')
+_ALIGN = 8
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+class UnsupportedCriteria(Exception):
+    pass
+
+
+class LocatorError(Exception):
+    def __init__(self, message, record_index, matches):
+        super().__init__(message)
+        # index of the criteria in the resolved path and numbers of elements it matched
+        self.record_index = record_index
+        self.matches = matches
+
+
+class LocatorNotFound(LocatorError):
+    pass
+
+
+class LocatorAmbiguous(LocatorError):
+    pass
+
+
+class _Strings:
+    """ Distinct strings sorted by utf-8 bytes, decoded on first use """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        self.decoded = [None] * (len(offsets) - 1)
+        # searched string -> number or None
+        self.found = {}
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def __getitem__(self, num):
+        if num == NO_STRING:
+            return None
+
+        value = self.decoded[num]
+        if value is None:
+            value = self.decoded[num] = bytes(self.data[self.offsets[num]:self.offsets[num + 1]]).decode('utf-8')
+
+        return value
+
+    def _bytes(self, num):
+        return bytes(self.data[self.offsets[num]:self.offsets[num + 1]])
+
+    def find(self, value) -> Optional[int]:
+        """ Number of the string or None """
+        try:
+            return self.found[value]
+        except KeyError:
+            pass
+
+        key = value.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        num = self.found[value] = low if low < len(self) and self._bytes(low) == key else None
+        return num
+
+
+class _Postings:
+    """ Sorted element numbers by value: numbers[offsets[i]:offsets[i + 1]] have the i-th value.
+
+        Values of string columns are numbers of strings, values of int columns are kept in sorted `values`. """
+
+    def __init__(self, offsets, numbers, values=None):
+        self.offsets = offsets
+        self.numbers = numbers
+        self.values = values
+
+    def get(self, code):
+        if self.values is None:
+            position = code if 0 <= code < len(self.offsets) - 1 else None
+        else:
+            position = bisect.bisect_left(self.values, code)
+            position = position if position < len(self.values) and self.values[position] == code else None
+
+        if position is None:
+            return ()
+
+        return self.numbers[self.offsets[position]:self.offsets[position + 1]]
+
+
+def _group(keys, count):
+    """ Counting sort of element numbers by keys 0 ... count - 1, returns (offsets, numbers) """
+    offsets = array.array('i', bytes(4 * (count + 1)))
+    for key in keys:
+        if key >= 0:
+            offsets[key + 1] += 1
+
+    for num in range(count):
+        offsets[num + 1] += offsets[num]
+
+    numbers = array.array('i', bytes(4 * offsets[count]))
+    position = array.array('i', offsets)
+    for num, key in enumerate(keys):
+        if key >= 0:
+            numbers[position[key]] = num
+            position[key] += 1
+
+    return offsets, numbers
+
+
+def _read(info):
+    """ (values of COLUMNS, rectangle), all properties are read before anything is stored """
+    rect = info.rectangle
+    return [getattr(info, name) for name in COLUMNS], \
+        (rect.left, rect.top, rect.right, rect.bottom) if rect else (0, 0, 0, 0)
+
+
+def _may_match(values, criteria):
+    """ Check of a top level window before its descendants are captured, found_index is not applied """
+    values = dict(zip(COLUMNS, values))
+    for key, value in criteria.items():
+        if key in CRITERIA_COLUMNS:
+            if values[CRITERIA_COLUMNS[key]] != value:
+                return False
+        elif key in REGEX_CRITERIA:
+            if not re.match(value, values[REGEX_CRITERIA[key]] or ''):
+                return False
+        elif key not in ('visible_only', 'enabled_only', 'found_index') + IGNORED_CRITERIA:
+            return True
+
+    return (values['visible'] or not criteria.get('visible_only', True)) and \
+        (values['enabled'] or not criteria.get('enabled_only', False))
+
+
+class _Builder:
+    """ Elements added in depth-first order, packed into columns at the end """
+
+    def __init__(self):
+        self.rows = []
+        self.rects = []
+        self.parents = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row, parent):
+        values, rect = row
+        self.rows.append(values)
+        self.rects.append(rect)
+        self.parents.append(parent)
+
+    def build(self):
+        count = len(self.rows)
+        sections = {}
+        strings = sorted({value if isinstance(value, str) else str(value)
+                          for row in self.rows for value in row[:len(STRING_COLUMNS)] if value is not None})
+        numbers = {value: num for num, value in enumerate(strings)}
+        encoded = [one.encode('utf-8') for one in strings]
+        offsets = array.array('I', [0])
+        for one in encoded:
+            offsets.append(offsets[-1] + len(one))
+
+        sections['strings.offsets'] = offsets
+        sections['strings.data'] = b''.join(encoded)
+        for column, name in enumerate(COLUMNS):
+            values = [row[column] for row in self.rows]
+            if name in STRING_COLUMNS:
+                codes = [NO_STRING if one is None else numbers[one if isinstance(one, str) else str(one)]
+                         for one in values]
+            elif name in INT_COLUMNS:
+                codes = [one if isinstance(one, int) else NULL for one in values]
+            else:
+                codes = [1 if one else 0 for one in values]
+
+            sections[name] = array.array(SECTIONS[name], codes)
+
+        sections['rects'] = array.array('i', [one for rect in self.rects for one in rect])
+        sections['parents'] = array.array('i', self.parents)
+        # subtree of a parent ends where the subtree of its last child ends
+        ends = array.array('i', range(1, count + 1))
+        for num in range(count - 1, 0, -1):
+            parent = self.parents[num]
+            if ends[num] > ends[parent]:
+                ends[parent] = ends[num]
+
+        sections['ends'] = ends
+        sections['children.offsets'], sections['children'] = _group(self.parents, count)
+        return TreeSnapshot(count, sections)
+
+
+class TreeSnapshot:
+    """ Properties of tree elements in depth-first order, element 0 is the root.
+
+        Every column is an array indexed by element number: strings are numbers in the table of distinct strings,
+        None is NO_STRING or NULL. `parents` holds the number of the parent element and `ends` the number after
+        the last descendant, so descendants of element i are i + 1 ... ends[i] - 1. Children of every element and
+        elements of every value of searched columns are indexed, indexes of a captured snapshot are built on first
+        search by the column.
+
+        save() writes the arrays to a file in native byte order, load() maps the file into memory without reading
+        it, searches touch only the pages of the indexes and columns they need. """
+
+    def __init__(self, count, sections):
+        self.count = count
+        self.sections = sections
+        self.strings = _Strings(sections['strings.offsets'], sections['strings.data'])
+        self.columns = {name: sections[name] for name in COLUMNS}
+        self.rects = sections['rects']
+        self.parents = sections['parents']
+        self.ends = sections['ends']
+        self.children_offsets = sections['children.offsets']
+        self.children_numbers = sections['children']
+        self.indexes = {}
+        self.map = None
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    @instrument.traced('snapshot.capture')
+    def capture(cls, provider: Optional[elementtree.ElementProvider] = None,
+                root: Optional[elementtree.Element] = None, windows=None):
+        """ Snapshot of the desktop `root` and its top level windows with descendants.
+
+            `windows` is a list of search criteria, top level windows matching none of them are kept without
+            descendants. Windows gone while they are captured are left out. """
+        provider = provider or elementtree.default_provider()
+        root = provider.root() if root is None else root
+        builder = _Builder()
+        builder.add(_read(provider.element_info(root)), -1)
+        try:
+            top_level = provider.children(root)
+        except provider.errors:
+            top_level = []
+
+        for window in top_level:
+            try:
+                row = _read(provider.element_info(window))
+                if windows is not None and not any(_may_match(row[0], one) for one in windows):
+                    builder.add(row, 0)
+                    continue
+
+                rows = [(_read(info), parent) for info, parent in provider.subtree(window)]
+            except provider.errors:
+                continue
+
+            first = len(builder)
+            for row, parent in rows:
+                builder.add(row, first + parent if parent >= 0 else 0)
+
+        snapshot = builder.build()
+        instrument.count('snapshot.elements', len(snapshot))
+        return snapshot
+
+    def _build_index(self, name):
+        column = self.columns[name]
+        if name in STRING_COLUMNS:
+            offsets, numbers = _group(column, len(self.strings))
+            self.sections[f'index.{name}.offsets'] = offsets
+            self.sections[f'index.{name}'] = numbers
+        else:
+            values = array.array('q', sorted(set(column)))
+            positions = {value: num for num, value in enumerate(values)}
+            offsets, numbers = _group([positions[one] for one in column], len(values))
+            self.sections[f'index.{name}.values'] = values
+            self.sections[f'index.{name}.offsets'] = offsets
+            self.sections[f'index.{name}'] = numbers
+
+    def index(self, name) -> _Postings:
+        """ Element numbers of the column by value """
+        postings = self.indexes.get(name)
+        if postings is None:
+            if f'index.{name}' not in self.sections:
+                self._build_index(name)
+
+            postings = self.indexes[name] = _Postings(self.sections[f'index.{name}.offsets'],
+                                                      self.sections[f'index.{name}'],
+                                                      self.sections.get(f'index.{name}.values'))
+
+        return postings
+
+    @instrument.traced('snapshot.save')
+    def save(self, file_path):
+        for name in STRING_COLUMNS + INT_COLUMNS:
+            self.index(name)
+
+        layout = []
+        offset = _HEADER.size + _SECTION.size * len(SECTIONS)
+        for name in SECTIONS:
+            offset += -offset % _ALIGN
+            size = memoryview(self.sections[name]).nbytes
+            layout.append((offset, size))
+            offset += size
+
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(_HEADER.pack(MAGIC, VERSION, self.count))
+            file.write(b''.join(_SECTION.pack(*one) for one in layout))
+            for name, (offset, size) in zip(SECTIONS, layout):
+                file.write(bytes(offset - file.tell()))
+                file.write(memoryview(self.sections[name]).cast('B'))
+
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    @instrument.traced('snapshot.load')
+    def load(cls, file_path):
+        """ Snapshot mapped from the file, the file stays mapped while the snapshot is used """
+        with open(file_path, 'rb') as file:
+            # empty file can not be mapped
+            if os.fstat(file.fileno()).st_size < _HEADER.size:
+                raise SnapshotFormatError('Not a tree snapshot')
+
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(data)
+        if _HEADER.unpack_from(view)[0] != MAGIC:
+            raise SnapshotFormatError('Not a tree snapshot')
+
+        magic, version, count = _HEADER.unpack_from(view)
+        if version != VERSION:
+            raise SnapshotFormatError(f'Unsupported tree snapshot version: {version}')
+
+        if len(view) < _HEADER.size + _SECTION.size * len(SECTIONS):
+            raise SnapshotFormatError('Tree snapshot is truncated: sections')
+
+        sections = {}
+        for num, (name, typecode) in enumerate(SECTIONS.items()):
+            offset, size = _SECTION.unpack_from(view, _HEADER.size + _SECTION.size * num)
+            if offset + size > len(view):
+                raise SnapshotFormatError(f'Tree snapshot is truncated: [{name}]')
+
+            sections[name] = view[offset:offset + size].cast(typecode)
+
+        snapshot = cls(count, sections)
+        snapshot.map = data
+        return snapshot
+
+    def children(self, num):
+        return self.children_numbers[self.children_offsets[num]:self.children_offsets[num + 1]]
+
+    def rectangle(self, num):
+        return tuple(self.rects[num * 4:num * 4 + 4])
+
+    def value(self, num, key):
+        """ Value of the element for search criteria `key` """
+        name = CRITERIA_COLUMNS[key]
+        code = self.columns[name][num]
+        if name in STRING_COLUMNS:
+            return self.strings[code]
+
+        return None if code == NULL else code
+
+    def _code(self, name, value):
+        """ Stored value for the search value, None if no element can have it """
+        if name in STRING_COLUMNS:
+            return self.strings.find(value) if isinstance(value, str) else None
+
+        return value if isinstance(value, int) and value != NULL else None
+
+    def _compile(self, criteria):
+        """ Returns ([(column, code)], [(column, pattern)], found_index, [(column name, code)] to look up),
+            None if nothing can match """
+        equal = []
+        patterns = []
+        lookups = []
+        found_index = None
+        visible_only = True
+        enabled_only = False
+        for key, value in criteria.items():
+            if key in CRITERIA_COLUMNS:
+                name = CRITERIA_COLUMNS[key]
+                code = self._code(name, value)
+                if code is None:
+                    return None
+
+                equal.append((self.columns[name], code))
+                lookups.append((name, code))
+            elif key in REGEX_CRITERIA:
+                patterns.append((self.columns[REGEX_CRITERIA[key]], re.compile(value)))
+            elif key == 'visible_only':
+                visible_only = value
+            elif key == 'enabled_only':
+                enabled_only = value
+            elif key == 'found_index':
+                found_index = value
+            elif key not in IGNORED_CRITERIA:
+                raise UnsupportedCriteria(f'criteria [{key}] is not supported by snapshot')
+
+        if visible_only:
+            equal.append((self.columns['visible'], 1))
+        if enabled_only:
+            equal.append((self.columns['enabled'], 1))
+
+        return equal, patterns, found_index, lookups
+
+    def find(self, anchor, criteria, deep=True):
+        """ Numbers of elements matching pywinauto search criteria among descendants of `anchor`, or among its
+            children if not `deep`, in document order. found_index is applied as pywinauto does. """
+        compiled = self._compile(criteria)
+        if compiled is None:
+            return []
+
+        equal, patterns, found_index, lookups = compiled
+        if lookups:
+            # elements of the rarest value inside the subtree of the anchor
+            first, end = anchor + 1, self.ends[anchor]
+            best = None
+            for name, code in lookups:
+                numbers = self.index(name).get(code)
+                low, high = bisect.bisect_left(numbers, first), bisect.bisect_left(numbers, end)
+                if best is None or high - low < best[2] - best[1]:
+                    best = numbers, low, high
+
+            numbers, low, high = best
+            candidates = numbers[low:high]
+            if not deep:
+                parents = self.parents
+                candidates = [num for num in candidates if parents[num] == anchor]
+        else:
+            candidates = range(anchor + 1, self.ends[anchor]) if deep else self.children(anchor)
+
+        strings = self.strings
+        found = [num for num in candidates
+                 if all(column[num] == code for column, code in equal) and
+                 all(pattern.match(strings[column[num]] or '') for column, pattern in patterns)]
+        if found_index is not None:
+            found = found[found_index:found_index + 1]
+
+        return found
+
+    def found_index(self, anchor, criteria, num, deep=True):
+        """ found_index of the element among the elements matching criteria without found_index, None if it is
+            the only one """
+        criteria = {key: value for key, value in criteria.items() if key != 'found_index'}
+        found = self.find(anchor, criteria, deep)
+        return found.index(num) if len(found) > 1 and num in found else None
+
+    def resolve(self, path):
+        """ Element numbers of path criteria resolved as uiaruntime.find_path does: the first criteria among top
+            level windows, each next one among descendants of the element found before.
+
+            Raises LocatorNotFound or LocatorAmbiguous for the first criteria not matching exactly one element. """
+        anchor = 0
+        out = []
+        for index, criteria in enumerate(path):
+            found = self.find(anchor, criteria, deep=index > 0)
+            if len(found) != 1:
+                cls = LocatorAmbiguous if found else LocatorNotFound
+                raise cls(f'{len(found)} elements match {criteria}', index, found)
+
+            anchor = found[0]
+            out.append(anchor)
+
+        return out
+
+
+def _main():
+    """ treesnapshot.py capture <path> - snapshot of the desktop into the file,
+        treesnapshot.py <path> - top level windows of the snapshot file """
+    if len(sys.argv) == 3 and sys.argv[1] == 'capture':
+        snapshot = TreeSnapshot.capture()
+        snapshot.save(sys.argv[2])
+        print(f'{len(snapshot)} elements saved to {sys.argv[2]}')
+    elif len(sys.argv) == 2:
+        snapshot = TreeSnapshot.load(sys.argv[1])
+        print(f'{len(snapshot)} elements')
+        for num in snapshot.children(0):
+            print(f'    [{snapshot.value(num, "title")}] {snapshot.value(num, "control_type")}, '
+                  f'{snapshot.ends[num] - num} elements')
+    else:
+        print(_main.__doc__)
+
+
+if __name__ == '__main__':
+    _main()
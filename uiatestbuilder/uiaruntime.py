@@ -0,0 +1,159 @@
+import time
+import collections
+
+import pywinauto
+from pywinauto.findwindows import ElementAmbiguousError, ElementNotFoundError
+
+
+CACHE_SIZE = 256
+
+desktop = pywinauto.Desktop(backend='uia', allow_magic_lookup=False)
+timing_hooks = []
+# TimingReport of the current run or None
+report = None
+_resolved = collections.OrderedDict()
+
+
+class TimingReport:
+    """ Resolve time, action time and retries of every action and every path record of the run.
+
+        actions: action_id -> [resolve seconds, action seconds, retries]
+        records: (action_id, record_id) -> [resolve seconds, cached, retries]
+        Retry is the record found again because the item resolved before is gone. """
+
+    def __init__(self):
+        self.actions = {}
+        self.records = {}
+        self.resolved_at = {}
+
+    def add_record(self, action_id, record_id, seconds, cached, retries):
+        self.records[(action_id, record_id)] = [seconds, cached, retries]
+
+    def add_resolve(self, action_id, seconds, retries):
+        self.actions[action_id] = [seconds, 0.0, retries]
+        self.resolved_at[action_id] = time.perf_counter()
+
+    def end_action(self, action_id):
+        resolved_at = self.resolved_at.pop(action_id, None)
+        if resolved_at is not None:
+            self.actions[action_id][1] = time.perf_counter() - resolved_at
+
+    def slowest_records(self, count=10, cached=None):
+        """ [(action_id, record_id, seconds, cached, retries)] by resolve time, only records with the given
+            `cached` flag if it is not None """
+        rows = [(action_id, record_id) + tuple(values) for (action_id, record_id), values in self.records.items()
+                if cached is None or values[1] == cached]
+        rows.sort(key=lambda row: -row[2])
+        return rows[:count]
+
+    def slowest_actions(self, count=10):
+        """ [(action_id, resolve seconds, action seconds, retries)] by total time """
+        rows = [(action_id, ) + tuple(values) for action_id, values in self.actions.items()]
+        rows.sort(key=lambda row: -(row[1] + row[2]))
+        return rows[:count]
+
+    def as_dict(self):
+        return {
+            'actions': [{'action_id': action_id, 'resolve_s': resolve, 'action_s': action, 'retries': retries}
+                        for action_id, (resolve, action, retries) in self.actions.items()],
+            'records': [{'action_id': action_id, 'record_id': record_id, 'resolve_s': seconds, 'cached': cached,
+                         'retries': retries}
+                        for (action_id, record_id), (seconds, cached, retries) in self.records.items()],
+        }
+
+
+def reset():
+    """ Forgets resolved items, called before every run """
+    _resolved.clear()
+
+
+def add_timing_hook(hook):
+    """ hook(action_id, record_id, seconds, cached) is called for every resolved path record """
+    timing_hooks.append(hook)
+
+
+def remove_timing_hook(hook):
+    timing_hooks.remove(hook)
+
+
+def _is_alive(item):
+    try:
+        return item.is_visible()
+    except Exception:
+        return False
+
+
+def _cached(key):
+    """ Returns (item or None, the item resolved before is gone) """
+    item = _resolved.get(key)
+    if item is None:
+        return None, False
+
+    if not _is_alive(item):
+        del _resolved[key]
+        return None, True
+
+    _resolved.move_to_end(key)
+    return item, False
+
+
+def _store(key, item):
+    _resolved[key] = item
+    if len(_resolved) > CACHE_SIZE:
+        _resolved.popitem(last=False)
+
+
+def _find(parent, criteria):
+    if parent is desktop:
+        spec = desktop.window(**criteria)
+    else:
+        # items under a window are not top level, unless the record is tuned to say so
+        criteria = dict(criteria)
+        criteria.setdefault('top_level_only', False)
+        spec = desktop.window(parent=parent, **criteria)
+
+    return spec.wrapper_object()
+
+
+def find_path(action_id, path):
+    """ Resolves item by path of (record_id, criteria), items found before are reused while they are alive """
+    timed = report is not None or timing_hooks
+    path_start = time.perf_counter() if timed else 0
+    path_retries = 0
+    item = desktop
+    key = ()
+    for record_id, criteria in path:
+        start = time.perf_counter() if timed else 0
+        key += (tuple(sorted(criteria.items())), )
+        found, retry = _cached(key)
+        cached = found is not None
+        if not cached:
+            try:
+                found = _find(item, criteria)
+            except (ElementAmbiguousError, ElementNotFoundError) as exc:
+                exc.action_id = action_id
+                exc.path_id = record_id
+                raise
+
+            _store(key, found)
+
+        item = found
+        if timed:
+            seconds = time.perf_counter() - start
+            for hook in timing_hooks:
+                hook(action_id, record_id, seconds, cached)
+
+            if report is not None:
+                report.add_record(action_id, record_id, seconds, cached, int(retry))
+                path_retries += retry
+
+    if report is not None:
+        report.add_resolve(action_id, time.perf_counter() - path_start, path_retries)
+
+    return item
+
+
+def end_action(action_id):
+    """ Called by debug scripts after the action on the resolved item """
+    if report is not None:
+        report.end_action(action_id)
@@ -1,13 +1,11 @@
 import time
 import threading
+import collections
 
-import pywinauto
-import pyautogui
-
-from comtypes import COMError
-from pywinauto.base_wrapper import BaseWrapper
-from typing import Optional
+from typing import Callable, Optional
 
+import elementtree
+import instrument
 import tools
 
 
@@ -15,26 +13,32 @@ class ItemPathRecord:
     class InvalidEnumStr(Exception):
         pass
 
-    def __init__(self, item: BaseWrapper, identical_items_index=None):
+    # incremented on every edit, class default covers records saved before it was introduced
+    version = 0
+
+    def __init__(self, item: elementtree.Element, identical_items_index=None,
+                 provider: Optional[elementtree.ElementProvider] = None, info=None):
+        """ `info` is element_info of the item fetched before, if it is given """
+        info = info or (provider or elementtree.default_provider()).element_info(item)
         self.id = tools.generate_id()
         self.props = {
-            '-class_name': item.element_info.class_name,
+            '-class_name': info.class_name,
             '-class_name_re': None,
-            '-process': item.element_info.process_id,
-            'title': item.element_info.name,
+            '-process': info.process_id,
+            'title': info.name,
             '-title_re': None,
             '-top_level_only': True,
-            '-visible_only': item.element_info.visible,
-            '-enabled_only': item.element_info.enabled,
+            '-visible_only': info.visible,
+            '-enabled_only': info.enabled,
             '-best_match': None,
-            '-handle': item.element_info.handle,
+            '-handle': info.handle,
             '-ctrl_index': None,
             '-found_index': identical_items_index,
             '-active_only': False,
-            'control_id': item.element_info.control_id,
-            'control_type': item.element_info.control_type,
-            'auto_id': item.element_info.automation_id,
-            '-framework_id': item.element_info.framework_id,
+            'control_id': info.control_id,
+            'control_type': info.control_type,
+            'auto_id': info.automation_id,
+            '-framework_id': info.framework_id,
             '-backend': None,
             '-depth': None
         }
@@ -53,6 +57,10 @@ class ItemPathRecord:
     def to_search_str(self, include_empty_props=False):
         return ', '.join([f'{k}={v}' for k, v in self._items(True, False, include_empty_props)])
 
+    def search_criteria(self):
+        """ Props the item is searched by at run, the same as in to_search_str """
+        return {k: v for k, v in self.props.items() if not k.startswith('-') and v is not None and v != ''}
+
     def _items(self, raw_str: bool, include_disabled: bool, include_empty: bool):
         for key, value in self.props.items():
             if include_disabled or not key.startswith('-'):
@@ -95,7 +103,10 @@ class ItemPathRecord:
             except (IndexError, ValueError):
                 raise self.InvalidEnumStr(f'[{self.friendly_name()}], invalid value: [{value}] for key [{key}]')
 
-        self.props = props
+        # order of props is the order of search keys in the code, unchanged record keeps the code of its actions
+        if list(props.items()) != list(self.props.items()):
+            self.props = props
+            self.version += 1
 
     def friendly_name(self):
         title = self['title']
@@ -103,46 +114,279 @@ class ItemPathRecord:
         return title[:20] if title else type
 
 
-class ItemPath:
-    def __init__(self, item: Optional[BaseWrapper] = None):
-        self.path = []
-        while item:
-            # TODO: get_identical_items_index() is very slow, must do it faster
-            # self.path.append(ItemPathRecord(item, self._get_identical_items_index(item)))
-            self.path.append(ItemPathRecord(item))
-            item = item.parent()
+class IdenticalItemsIndex:
+    """ Snapshots of top level windows descendants indexed by (name, automation_id, control_type, control_id).
 
-        self.path.reverse()
+        Snapshot keeps rectangles of identical items, they are fetched with other properties at once. Snapshot
+        older than `ttl` seconds is taken again, items removed from the window do not stay in it. After
+        mark_changed() every bucket is read again from the window when it is used next. """
+
+    def __init__(self, provider: Optional[elementtree.ElementProvider] = None, ttl=2.0):
+        self.provider = provider or elementtree.default_provider()
+        self.ttl = ttl
+        # incremented by mark_changed()
+        self.generation = 0
+        # top key -> (time, snapshot, {key: generation the bucket is read at})
+        self.snapshots = {}
+
+    @staticmethod
+    def _key(info):
+        return info.name, info.automation_id, info.control_type, info.control_id
+
+    def _top_key(self, top_item: elementtree.Element, top_info=None):
+        info = top_info or self.provider.element_info(top_item)
+        return info.handle, tuple(info.runtime_id)
+
+    @instrument.traced('index.snapshot')
+    def _build_snapshot(self, top_item: elementtree.Element, top_info=None):
+        snapshot = {}
+        top_info = top_info or self.provider.element_info(top_item)
+        snapshot[self._key(top_info)] = [top_info.rectangle]
+        for one, info in self.provider.descendant_infos(top_item):
+            snapshot.setdefault(self._key(info), []).append(info.rectangle)
+
+        return snapshot
+
+    def _refresh_bucket(self, snapshot, top_item: elementtree.Element, key, top_info=None):
+        # update only items with the given key, title and control type are matched on the provider side
+        name, auto_id, control_type, control_id = key
+        candidates = [top_info or self.provider.element_info(top_item), ]
+        candidates += [info for one, info in self.provider.descendant_infos(top_item, name, control_type)]
+        snapshot[key] = [info.rectangle for info in candidates if self._key(info) == key]
 
     @staticmethod
-    def _get_identical_items_index(item: BaseWrapper):
-        top_item = item.top_level_parent()
-        all_items = [top_item, ] + top_item.descendants()
-        identical = []
-        for one in all_items:
-            if one.element_info.name == item.element_info.name:
-                if one.element_info.automation_id == item.element_info.automation_id:
-                    if one.element_info.control_type == item.element_info.control_type:
-                        if one.element_info.control_id == item.element_info.control_id:
-                            identical.append(one)
-
-        if len(identical) < 2:
+    def _find(bucket, rect):
+        try:
+            return bucket.index(rect)
+        except ValueError:
             return None
 
-        for index, one in enumerate(identical):
-            if one.rectangle() == item.rectangle():
-                return index
+    def get_index(self, item: elementtree.Element, info=None, top_item: Optional[elementtree.Element] = None,
+                  top_info=None):
+        """ `info`, `top_item` of the item and `top_info` of it are fetched here if they are not given, None if
+            the item has no identical items or it is not found among descendants of `top_item` """
+        info = info or self.provider.element_info(item)
+        if top_item is None:
+            top_item = self.provider.top_level_parent(item)
+            top_info = None
+
+        top_key = self._top_key(top_item, top_info)
+        now = time.monotonic()
+        entry = self.snapshots.get(top_key)
+        generation = self.generation
+        if entry is None or entry[0] < now - self.ttl:
+            entry = self.snapshots[top_key] = (now, self._build_snapshot(top_item, top_info), {None: generation})
+
+        time_taken, snapshot, read_at = entry
+        key = self._key(info)
+        rect = info.rectangle
+        fresh = read_at.get(key, read_at[None]) == generation
+        index = self._find(snapshot.get(key, []), rect) if fresh else None
+        if index is None:
+            # item appeared after the snapshot was taken or identical items may be gone since the last change
+            self._refresh_bucket(snapshot, top_item, key, top_info)
+            read_at[key] = generation
+            index = self._find(snapshot[key], rect)
+
+        if index is None:
+            # item moved since it was hit or it is outside of descendants of the top level window, like a popup
+            return None
+
+        return index if len(snapshot[key]) > 1 else None
+
+    def mark_changed(self):
+        """ Layout of windows may have changed, identical items are counted again """
+        self.generation += 1
+
+    def invalidate(self, top_item: Optional[elementtree.Element] = None):
+        if top_item is None:
+            # scanning thread keeps using the dict it has taken
+            self.snapshots = {}
+        else:
+            self.snapshots.pop(self._top_key(top_item), None)
+
+
+class ItemPathTreeNode:
+    def __init__(self, record: ItemPathRecord, parent=None):
+        self.record = record
+        self.parent = parent
+
+    def records(self):
+        out = []
+        node = self
+        while node:
+            out.append(node.record)
+            node = node.parent
 
-        assert False
+        out.reverse()
+        return out
+
+
+class ItemPathTree:
+    """ Prefix tree of interned path records, an already recorded item is shared with its chain of parents.
+
+        Records are interned by runtime id and name, other identifying props are checked on reuse, as runtime ids
+        and window handles are recycled. The least recently used of `max_nodes` records leave the tree first. """
+
+    def __init__(self, provider: Optional[elementtree.ElementProvider] = None, max_nodes=10000):
+        self.provider = provider or elementtree.default_provider()
+        self.max_nodes = max_nodes
+        # key -> (identifying props, node)
+        self.nodes = collections.OrderedDict()
+
+    @staticmethod
+    def _key(info):
+        runtime_id = info.runtime_id
+        return (tuple(runtime_id), info.name) if runtime_id else None
+
+    @staticmethod
+    def _ident(info):
+        return info.automation_id, info.class_name, info.control_type, info.process_id
+
+    def get_path(self, item: Optional[elementtree.Element],
+                 identical_items_index: Optional[IdenticalItemsIndex] = None):
+        created = []
+        node = None
+        # properties of every parent are fetched along with it, the walk stops at the first interned one
+        ancestors = self.provider.ancestors(item) if item else iter(())
+        walked = []
+        for item, info in ancestors:
+            walked.append((item, info))
+            key = self._key(info)
+            entry = self.nodes.get(key) if key else None
+            if entry and entry[0] == self._ident(info):
+                node = entry[1]
+                self.nodes.move_to_end(key)
+                instrument.count('path.interned_hits')
+                break
+
+            created.append((key, item, info))
+
+        indexes = [None] * len(created)
+        if identical_items_index and created:
+            # the top level window is the item under the root, the rest of the chain comes with cached infos too
+            walked.extend(ancestors)
+            top_item, top_info = walked[-2] if len(walked) > 1 else walked[-1]
+            # the root has no parent and no index
+            with_parent = len(created) if node else len(created) - 1
+            for num in range(with_parent):
+                key, item, info = created[num]
+                indexes[num] = identical_items_index.get_index(item, info, top_item, top_info)
+
+        created = [(key, self._ident(info), ItemPathRecord(item, index, self.provider, info))
+                   for (key, item, info), index in zip(created, indexes)]
+        instrument.count('path.records', len(created))
+        for key, ident, record in reversed(created):
+            node = ItemPathTreeNode(record, node)
+            if key:
+                self.nodes[key] = (ident, node)
+                self.nodes.move_to_end(key)
+
+        while len(self.nodes) > self.max_nodes:
+            # paths of the evicted records keep them
+            self.nodes.popitem(last=False)
+
+        return node.records() if node else []
+
+
+class ItemPath:
+    def __init__(self, item: Optional[elementtree.Element] = None,
+                 identical_items_index: Optional[IdenticalItemsIndex] = None, tree: Optional[ItemPathTree] = None,
+                 provider: Optional[elementtree.ElementProvider] = None):
+        # records are shared with other paths built on the same tree
+        if item is None:
+            self.path = []
+        else:
+            with instrument.span('path.capture'):
+                self.path = (tree or ItemPathTree(provider)).get_path(item, identical_items_index)
 
     def __str__(self):
         return ''.join([f'[{x.friendly_name()}]' for x in self.path])
 
 
+class HitTestEntry:
+    def __init__(self, item: elementtree.Element, rect, holes):
+        self.item = item
+        self.rect = rect
+        self.bounds = _rect_bounds(rect)
+        self.holes = [_rect_bounds(one) for one in holes]
+        self.path = None
+        self.time = time.monotonic()
+
+    def contains(self, x, y):
+        return _bounds_contain(self.bounds, x, y) and not any(_bounds_contain(one, x, y) for one in self.holes)
+
+    def area(self):
+        left, top, right, bottom = self.bounds
+        return (right - left) * (bottom - top)
+
+
+class HitTestCache:
+    """ Grid index of item rectangles already resolved in the foreground window """
+
+    def __init__(self, cell_size=64, ttl=2.0):
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self.window_key = None
+        self.cells = {}
+
+    def _cell_keys(self, bounds):
+        left, top, right, bottom = bounds
+        for x in range(left // self.cell_size, right // self.cell_size + 1):
+            for y in range(top // self.cell_size, bottom // self.cell_size + 1):
+                yield x, y
+
+    def check_window(self, window_key):
+        """ Returns True if another window is in the foreground or it is moved """
+        if window_key == self.window_key:
+            return False
+
+        self.invalidate()
+        self.window_key = window_key
+        return True
+
+    def invalidate(self):
+        self.cells = {}
+
+    def add(self, item: elementtree.Element, rect, holes=()):
+        entry = HitTestEntry(item, rect, holes)
+        cells = self.cells
+        for key in self._cell_keys(entry.bounds):
+            bucket = [one for one in cells.get(key, []) if one.bounds != entry.bounds]
+            bucket.append(entry)
+            cells[key] = bucket
+
+        return entry
+
+    def find(self, x, y) -> Optional[HitTestEntry]:
+        expired = time.monotonic() - self.ttl
+        found = None
+        for one in self.cells.get((x // self.cell_size, y // self.cell_size), []):
+            if one.time >= expired and one.contains(x, y):
+                if found is None or one.area() < found.area():
+                    found = one
+
+        return found
+
+
+def _rect_bounds(rect):
+    return rect.left, rect.top, rect.right, rect.bottom
+
+
+def _bounds_contain(bounds, x, y):
+    left, top, right, bottom = bounds
+    return left <= x < right and top <= y < bottom
+
+
 class Scanner:
-    def __init__(self):
-        self.initial_item = pywinauto.Desktop(backend='uia')
+    def __init__(self, path_listener: Optional[Callable[[], None]] = None,
+                 provider: Optional[elementtree.ElementProvider] = None):
+        self.provider = provider or elementtree.default_provider()
         self.current_path = ItemPath()
+        self.path_listener = path_listener
+        self.identical_items_index = IdenticalItemsIndex(self.provider)
+        self.item_path_tree = ItemPathTree(self.provider)
+        self.hit_test_cache = HitTestCache()
         self.cur_item_rect = None
         self.is_scanning = False
         self.scanning_thread = None
@@ -161,37 +405,80 @@ class Scanner:
             self.scanning_thread.join(timeout=5)
             self.scanning_thread = None
 
-    def _is_same_item(self, item):
-        rect = item.rectangle()
+    def reset_paths(self):
+        """ Forgets records of paths built before, paths of a new scenario do not share them """
+        self.item_path_tree = ItemPathTree(self.provider)
+        self.hit_test_cache.invalidate()
+        self.current_path = ItemPath()
+
+    def invalidate_cache(self):
+        # identical items come and go along with the layout
+        self.hit_test_cache.invalidate()
+        self.identical_items_index.mark_changed()
+
+    def _is_same_item(self, rect):
         same = self.cur_item_rect == rect
         if not same:
             self.cur_item_rect = rect
 
         return same
 
+    def _hit_test(self, x, y) -> HitTestEntry:
+        provider = self.provider
+        if self.hit_test_cache.check_window(provider.window_key()):
+            self.identical_items_index.invalidate()
+        entry = self.hit_test_cache.find(x, y)
+        if entry is None:
+            item = provider.from_point(x, y)
+            entry = self.hit_test_cache.add(item, provider.rectangle(item), provider.child_rectangles(item))
+
+        return entry
+
     def _scan(self):
         count = 0
         highlight = 'red'
         while self.is_scanning:
-            try:
-                item = self.initial_item.from_point(*pyautogui.position())
-                if self._is_same_item(item):
-                    count += 1
-                else:
-                    count = 0
-                    highlight = 'red'
+            with instrument.span('scanner.scan'):
+                try:
+                    entry = self._hit_test(*self.provider.cursor_position())
+                    if self._is_same_item(entry.rect):
+                        count += 1
+                    else:
+                        count = 0
+                        highlight = 'red'
 
-                if count == 3:
-                    self.current_path = ItemPath(item)
-                    highlight = 'green'
-                    count += 1
+                    if count == 3 and not entry.path:
+                        entry.path = ItemPath(entry.item, self.identical_items_index, self.item_path_tree)
 
-                item.draw_outline(colour=highlight, thickness=2)
-            except (COMError, KeyError):
-                self.current_path = ItemPath()
+                    if entry.path and count <= 3:
+                        # known item is shown as resolved at once
+                        self._set_current_path(entry.path)
+                        highlight = 'green'
+                        count = 4
+
+                    self.provider.draw_outline(entry.item, highlight, entry.rect)
+                except self.provider.errors + (KeyError, ):
+                    self._set_current_path(ItemPath())
 
             time.sleep(0.2)
 
+    @instrument.traced('scanner.scan_at')
+    def scan_at(self, x, y):
+        """ Resolves item under (x, y) at once, replays call it instead of running the scanning thread """
+        entry = self._hit_test(x, y)
+        if not entry.path:
+            entry.path = ItemPath(entry.item, self.identical_items_index, self.item_path_tree)
+
+        self._set_current_path(entry.path)
+
+    def _set_current_path(self, path: ItemPath):
+        if path is self.current_path or not (path.path or self.current_path.path):
+            return
+
+        self.current_path = path
+        if self.path_listener:
+            self.path_listener()
+
     def get_item_path(self) -> ItemPath:
         return self.current_path
 
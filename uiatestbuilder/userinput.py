@@ -1,47 +1,128 @@
 import time
+import queue
+import heapq
+import functools
+import itertools
 import threading
-from pywinauto.win32_hooks import Hook
-from pywinauto.win32_hooks import KeyboardEvent
-from pywinauto.win32_hooks import MouseEvent
-from typing import Callable, List, Any
+import traceback
+from typing import Callable, List, Any, Optional
+
+import instrument
+
+try:
+    from pywinauto.win32_hooks import Hook
+    from pywinauto.win32_hooks import KeyboardEvent
+    from pywinauto.win32_hooks import MouseEvent
+except ImportError:
+    # recorded input can be replayed without hooks
+    Hook = KeyboardEvent = MouseEvent = None
+
+
+class DeadlineScheduler:
+    """ One long-lived thread calling callbacks at their deadlines (time.monotonic) """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_at(self, deadline, callback: Callable[[], None]):
+        with self.condition:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+            heapq.heappush(self.heap, (deadline, next(self.counter), callback))
+            self.condition.notify()
+
+    def _run(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                callback = heapq.heappop(self.heap)[2]
+                self.condition.release()
+                try:
+                    callback()
+                except Exception:
+                    # one failed callback must not stop deadlines of the following clicks
+                    traceback.print_exc()
+                    instrument.count('input.scheduler_errors')
+                finally:
+                    self.condition.acquire()
 
 
 class MouseInputHandler:
-    def __init__(self, click_handler: Callable[[str, bool, Any], None], click_context_builder: Callable):
+    def __init__(self, click_handler: Callable[[str, bool, Any], None], click_context_builder: Callable,
+                 double_click_time=0.3, scheduler: Optional[DeadlineScheduler] = None):
         self.click_handler = click_handler
         self.get_click_context = click_context_builder
+        self.double_click_time = double_click_time
+        self.scheduler = scheduler or DeadlineScheduler()
         self.click_context = None
 
-        self.was_left_double_click = False
-        self.was_left_single_click = False
-        self.left_click_thread = None
+        # serial number of the left click waiting for the second one
+        self.click_serial = 0
+        self.pending_click = None
+        self.pending_click_time = 0
         self.left_click_lock = threading.Lock()
 
-    def _left_single_click(self):
-        time.sleep(0.3)
+    def _left_single_click(self, serial):
         with self.left_click_lock:
-            if not self.was_left_double_click:
-                self.was_left_single_click = True
-                self.click_handler('left', False, self.click_context)
-
-    def on_left_click(self):
-        new_click = True
-
-        if self.left_click_thread:
-            with self.left_click_lock:
-                if not self.was_left_single_click:
-                    self.was_left_double_click = True
-                    self.click_handler('left', True, self.click_context)
-                    new_click = False
-            self.left_click_thread.join()
-            self.left_click_thread = None
-
-        if new_click:
-            self.click_context = self.get_click_context()
-            self.was_left_double_click = False
-            self.was_left_single_click = False
-            self.left_click_thread = threading.Thread(target=self._left_single_click)
-            self.left_click_thread.start()
+            if self.pending_click != serial:
+                return
+
+            self.pending_click = None
+            context = self.click_context
+
+        self.click_handler('left', False, context)
+
+    def on_left_click(self, timestamp=None):
+        """ Classifies click by `timestamp` (time.monotonic), never waits """
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self.left_click_lock:
+            waiting = self.pending_click is not None
+            previous_context = self.click_context
+            self.pending_click = None
+            double = waiting and timestamp - self.pending_click_time <= self.double_click_time
+            if not double:
+                self.click_serial += 1
+                serial = self.pending_click = self.click_serial
+                self.pending_click_time = timestamp
+                self.click_context = self.get_click_context()
+
+        if double:
+            self.click_handler('left', True, previous_context)
+            return
+
+        if waiting:
+            # scheduler is late, the previous click is single for sure
+            self.click_handler('left', False, previous_context)
+
+        self.scheduler.call_at(timestamp + self.double_click_time, functools.partial(self._left_single_click, serial))
+
+    def flush(self, timestamp=None):
+        """ Reports the pending left click as single at once or if it can not become double by `timestamp` """
+        with self.left_click_lock:
+            serial = self.pending_click
+            if timestamp is not None and timestamp - self.pending_click_time <= self.double_click_time:
+                return
+
+        if serial is not None:
+            self._left_single_click(serial)
+
+    def cancel(self):
+        """ Forgets the pending left click, it is never reported """
+        with self.left_click_lock:
+            self.pending_click = None
 
     def on_right_click(self):
         self.click_handler('right', False, self.get_click_context())
@@ -55,18 +136,60 @@ class KeyboardInputHandler:
         self.key_press_handler(pressed_key)
 
 
+class InputStats:
+    """ Counters of the input pipeline, updated by the worker thread """
+
+    def __init__(self):
+        self.events = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, latency, queue_depth):
+        self.events += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def mean_latency(self):
+        return self.total_latency / self.events if self.events else 0.0
+
+    def __str__(self):
+        return (f'events={self.events}, dropped={self.dropped}, max_queue_depth={self.max_queue_depth}, '
+                f'mean_latency={self.mean_latency() * 1e3:.1f}ms, max_latency={self.max_latency * 1e3:.1f}ms')
+
+
 class UserInput:
-    def __init__(self, mouse_input_handler: MouseInputHandler, keyboard_input_handler: KeyboardInputHandler):
+    """ Hook callback only puts timestamped events into the queue, handlers are called by the worker thread """
+
+    MOUSE_LEFT = 'left'
+    MOUSE_RIGHT = 'right'
+    KEYBOARD = 'key'
+
+    def __init__(self, mouse_input_handler: MouseInputHandler, keyboard_input_handler: KeyboardInputHandler,
+                 queue_size=1024):
         self.mouse_input_handler = mouse_input_handler
         self.keyboard_input_handler = keyboard_input_handler
-        self.hook = Hook()
-        self.hook.handler = self._on_keyboard_mouse_event
+        self.hook = None
         self.thread = None
+        self.worker = None
+        self.events = queue.Queue(queue_size)
+        self.stats = InputStats()
+        self.cursor = (0, 0)
+        self.event_log = None
 
-    def start(self):
+    def start(self, event_log=None):
+        """ Handled events are written to `event_log` (inputlog.InputLogWriter) if it is given """
         if self.thread:
             self.stop()
 
+        self.stats = InputStats()
+        self.event_log = event_log
+        self.hook = Hook()
+        self.hook.handler = self._on_keyboard_mouse_event
+        self.worker = threading.Thread(target=self._handling_events)
+        self.worker.start()
         self.thread = threading.Thread(target=self._hooking_input)
         self.thread.start()
 
@@ -75,21 +198,57 @@ class UserInput:
             self.hook.stop()
             self.thread.join()
             self.thread = None
+            self.events.put(None)
+            self.worker.join()
+            self.worker = None
+            self.event_log = None
 
     def _hooking_input(self):
         self.hook.hook(keyboard=True, mouse=True)
 
+    def put_event(self, kind, timestamp, x=0, y=0, key=None):
+        """ Never blocks, event is dropped and counted when the worker lags too far behind """
+        try:
+            self.events.put_nowait((kind, timestamp, x, y, key))
+        except queue.Full:
+            self.stats.dropped += 1
+
     def _on_keyboard_mouse_event(self, event):
+        timestamp = time.monotonic()
         if isinstance(event, MouseEvent):
             # print(event.event_type, event.current_key)
+            self.cursor = (event.mouse_x, event.mouse_y)
             if event.event_type == 'key down':
                 if event.current_key == 'LButton':
-                    self.mouse_input_handler.on_left_click()
+                    self.put_event(self.MOUSE_LEFT, timestamp, *self.cursor)
                 elif event.current_key == 'RButton':
-                    self.mouse_input_handler.on_right_click()
+                    self.put_event(self.MOUSE_RIGHT, timestamp, *self.cursor)
         elif isinstance(event, KeyboardEvent):
             # print(event.pressed_key)
-            self.keyboard_input_handler.on_key_press(event.pressed_key)
+            self.put_event(self.KEYBOARD, timestamp, *self.cursor, list(event.pressed_key))
+
+    def handle_event(self, kind, timestamp, x=0, y=0, key=None):
+        if kind == self.MOUSE_LEFT:
+            self.mouse_input_handler.on_left_click(timestamp)
+        elif kind == self.MOUSE_RIGHT:
+            self.mouse_input_handler.on_right_click()
+        elif kind == self.KEYBOARD:
+            self.keyboard_input_handler.on_key_press(key)
+
+    def _handling_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+
+            queue_depth = self.events.qsize() + 1
+            if self.event_log:
+                self.event_log.write_event(*event)
+
+            with instrument.span('input.event', kind=event[0]):
+                self.handle_event(*event)
+
+            self.stats.add(time.monotonic() - event[1], queue_depth)
 
 
 def _main():